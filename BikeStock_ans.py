@@ -3,6 +3,7 @@
 >>> import tempfile
 >>> bike_file = os.path.join(tempfile.gettempdir(), "bikes.dat")
 >>> if os.path.exists(bike_file): os.remove(bike_file)
+>>> if os.path.exists(bike_file + ".idx"): os.remove(bike_file + ".idx")
 
 >>> bike_data = []
 >>> bike_data.append(('REFK2', 'Reflex Kalahari', 5, 200.97))
@@ -54,6 +55,8 @@
 ...     value += bike.value
 >>> all(ok), "{0:.2f}".format(round(value, 2))
 (True, '35969.57')
+>>> "{0:.2f}".format(round(bicycles.total_value(), 2))
+'35969.57'
 >>> bicycles["SALEASY"].name
 'Salcano Easy'
 >>> bicycles.change_name("SALEASY", "Salcano EZ")
@@ -66,6 +69,10 @@ True
 ...         total += bike.quantity
 >>> total
 17
+>>> bicycles.total_quantity("B4U"), bicycles.total_quantity()
+(17, 133)
+>>> bicycles.bikes_below(1)
+['REFONA', 'B4U16RS', 'TIGB', 'CLACHA', 'AMMT+C', 'AMMCT', 'SALEASY']
 >>> total = 0
 >>> for bike in bicycles:
 ...     if bike.identity.startswith("B4U"):
@@ -88,13 +95,151 @@ True
 ...     value += bike.value
 >>> "{0:.2f}".format(round(value, 2))
 '37837.17'
+>>> bicycles.apply_updates({"REFK2": 3, "GEKKO": -6, "VENTGL": 1})
+>>> [bicycles[identity].quantity for identity in ("REFK2", "GEKKO",
+...                                               "VENTGL")]
+[8, 0, 2]
+>>> with bicycles.updates() as deltas:
+...     deltas["REFK2"] -= 3
+...     deltas["GEKKO"] += 6
+...     deltas["VENTGL"] -= 1
+>>> [bicycles[identity].quantity for identity in ("REFK2", "GEKKO",
+...                                               "VENTGL")]
+[5, 6, 1]
+>>> bicycles.apply_updates({"REFK2": 1, "GEKKO": -7}) # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+AssertionError: quantity must not be negative
+>>> bicycles["REFK2"].quantity
+5
+>>> bicycles.close()
+
+>>> record = _BIKE_STRUCT.pack(b"REFK2", b"Reflex Kalahari", 99, 200.97)
+>>> _write_update_journal(bike_file + ".journal", [(0, record)])
+>>> bicycles = BikeStock(bike_file)
+>>> bicycles["REFK2"].quantity, os.path.exists(bike_file + ".journal")
+(99, False)
+>>> bicycles.apply_updates({"REFK2": -94})
 >>> bicycles.close()
 >>> os.path.getsize(bike_file)
 1800
+>>> os.path.getsize(bike_file + ".idx") == 16 + 36 * 12
+True
+
+>>> index = _IdentityIndex(bike_file + ".idx", bike_file)
+>>> len(index.load(36)[0]), index.load(35)
+(36, None)
+>>> index.close()
+>>> with open(bike_file + ".idx", "r+b") as fh:
+...     position = fh.seek(-1, os.SEEK_END)
+...     written = fh.write(bytes([255]))
+>>> bicycles = BikeStock(bike_file)
+>>> bicycles["VENTGL"].price
+383.67
+>>> del bicycles["REFK2"]
+>>> del bicycles["ASBC"]
+>>> bicycles["VENTGL"].price, bicycles["AMMC"].name
+(383.67, 'Ammaco Commuter')
+>>> len(list(bicycles)), os.path.getsize(bike_file)
+(34, 1800)
+>>> bicycles["ASBC"] # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+KeyError: 'ASBC'
+>>> bicycles.append(Bike("ASBC2", "AS Bikes Compact 2", 1, 250.0))
+>>> bicycles.close()
+>>> os.path.getsize(bike_file), os.path.getsize(bike_file + ".idx")
+(1800, 484)
+
+>>> bicycles = BikeStock(bike_file)
+>>> bicycles["ASBC2"].quantity, bicycles["VENTGL"].quantity
+(1, 1)
+>>> for bike in bike_data[9:20]:
+...     del bicycles[bike[0]]
+>>> len(list(bicycles)), os.path.getsize(bike_file) // 50
+(24, 36)
+>>> [bicycles[identity].price for identity in ("ASBC2", "VENTGL")]
+[250.0, 383.67]
+>>> bicycles.compact()
+>>> os.path.getsize(bike_file) // 50, bicycles["VENTGL"].price
+(24, 383.67)
+>>> for bike in bike_data[20:34]:
+...     del bicycles[bike[0]]
+>>> os.path.getsize(bike_file) // 50, bicycles["VENTGL"].price
+(11, 383.67)
+>>> bicycles.close()
+>>> bicycles = BikeStock(bike_file)
+>>> sorted(bike.identity for bike in bicycles)
+['ASBC2', 'B4U16RS', 'B4U20', 'B4U20MTB', 'CLAMEL', 'REFA3', 'REFONA', 'REFT1', 'UNISTOW', 'VENTGL']
+>>> bicycles["CLAMEL"].price
+379.61
+>>> bicycles.identities_priced_between(220, 260)
+['B4U16RS', 'B4U20', 'B4U20MTB', 'REFA3', 'ASBC2']
+>>> bicycles.identities_named("reflex")
+['REFONA', 'REFT1', 'REFA3']
+>>> bicycles.change_price("REFT1", 255.0)
+True
+>>> bicycles.identities_priced_between(250, 260)
+['ASBC2', 'REFT1']
+>>> bicycles.change_name("REFA3", "Raleigh Axiom")
+True
+>>> bicycles.append(Bike("REFX", "Reflex X", 1, 230.0))
+>>> bicycles.identities_named("Reflex ")
+['REFONA', 'REFT1', 'REFX']
+>>> del bicycles["REFT1"]
+>>> bicycles.identities_named("reflex")
+['REFONA', 'REFX']
+>>> bicycles.identities_priced_between(225, 260)
+['REFX', 'ASBC2']
+>>> bicycles.close()
+
+>>> data = BinaryRecordFile_ans.BinaryRecordFile(bike_file, _BIKE_STRUCT.size,
+...         tombstone=bytes(_BIKE_STRUCT.size))
+>>> del data[0]
+>>> data.close()
+>>> bicycles = BikeStock(bike_file)
+>>> "ASBC2" in [bike.identity for bike in bicycles]
+False
+>>> bicycles["ASBC2"] # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+KeyError: 'ASBC2'
+>>> size = os.path.getsize(bike_file)
+>>> bicycles.append(Bike("ASBC3", "AS Bikes Compact 3", 1, 250.0))
+>>> bicycles.close()
+>>> os.path.getsize(bike_file) == size
+True
+>>> bicycles = BikeStock(bike_file)
+>>> bicycles["ASBC3"].quantity
+1
+>>> del bicycles["VENTGL"]
+>>> bicycles.close()
+>>> data = BinaryRecordFile_ans.BinaryRecordFile(bike_file, _BIKE_STRUCT.size,
+...         tombstone=bytes(_BIKE_STRUCT.size))
+>>> bike = Bike("VENT2", "Ventura 2", 2, 390.0)
+>>> index = data.append(_record_from_bike(bike))
+>>> data.close()
+>>> bicycles = BikeStock(bike_file)
+>>> bicycles["VENT2"].quantity
+2
+>>> bicycles.append(Bike("VENT3", "Ventura 3", 3, 395.0))
+>>> sorted(bike.identity for bike in bicycles if bike.price > 380)
+['VENT2', 'VENT3']
+>>> bicycles["ASBC2"] # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+KeyError: 'ASBC2'
+>>> bicycles.close()
 >>> if os.path.exists(bike_file): os.remove(bike_file)
+>>> if os.path.exists(bike_file + ".idx"): os.remove(bike_file + ".idx")
 """
 
+import bisect
+import collections
+import contextlib
+import os
 import struct
+import zlib
 import BinaryRecordFile_ans
 
 
@@ -155,6 +300,7 @@ class Bike:
 
 
 _BIKE_STRUCT = struct.Struct("<8s30sid")
+_SCAN_RECORDS = 65536
 
 
 def _bike_from_record(record):
@@ -171,50 +317,312 @@ def _record_from_bike(bike):
                              bike.quantity, bike.price)
 
 
+_JOURNAL_HEADER = struct.Struct("<4sII")
+_JOURNAL_ENTRY = struct.Struct("<I{0}s".format(_BIKE_STRUCT.size))
+_JOURNAL_MAGIC = b"BKTX"
+
+
+def _write_update_journal(filename, writes):
+    """Writes the (index, record) pairs of writes to filename and
+    waits until they are on the disk
+    """
+    body = b"".join(_JOURNAL_ENTRY.pack(index, record)
+                    for index, record in writes)
+    with open(filename, "wb") as fh:
+        fh.write(_JOURNAL_HEADER.pack(_JOURNAL_MAGIC, len(writes),
+                                      zlib.crc32(body)))
+        fh.write(body)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def _read_update_journal(filename):
+    """Returns the (index, record) pairs written to filename, or None
+    if it is missing or was not completely written
+    """
+    try:
+        with open(filename, "rb") as fh:
+            data = fh.read()
+    except EnvironmentError:
+        return None
+    if len(data) < _JOURNAL_HEADER.size:
+        return None
+    magic, count, crc = _JOURNAL_HEADER.unpack_from(data)
+    body = data[_JOURNAL_HEADER.size:]
+    if (magic != _JOURNAL_MAGIC or
+        len(body) != count * _JOURNAL_ENTRY.size or
+        zlib.crc32(body) != crc):
+        return None
+    return list(_JOURNAL_ENTRY.iter_unpack(body))
+
+
+class _IdentityIndex:
+
+    HeaderStruct = struct.Struct("<4sIII")
+    EntryStruct = struct.Struct("<8sI")
+    Magic = b"BKIX"
+    Deleted = 0xFFFFFFFF
+
+    def __init__(self, filename, data_filename):
+        """The sidecar file that maps bike identities to the index
+        positions of their records in the file data_filename
+
+        It is a header of the magic number, the number of records the
+        data file held when the index was last written, the number of
+        entries, and the CRC-32 of the entries, followed by one entry
+        per bike added to or deleted from the data file; a deletion's
+        index is Deleted. Entries are only ever appended, and the
+        header is rewritten after each of them; the log is rewritten
+        from scratch when the data file is compacted.
+        """
+        self.filename = filename
+        self.data_filename = data_filename
+        self.__fh = None
+        self.__entries = 0
+        self.__crc = 0
+
+
+    def load(self, record_count):
+        """Returns the dict of identities to index positions and the set
+        of deleted positions, or None if the index is missing, corrupt,
+        or out of step with the data file, which must hold record_count
+        records
+        """
+        try:
+            with open(self.filename, "rb") as fh:
+                data = fh.read()
+        except EnvironmentError:
+            return None
+        size = self.HeaderStruct.size
+        if len(data) < size:
+            return None
+        magic, records, entries, crc = self.HeaderStruct.unpack_from(data)
+        body = memoryview(data)[size:]
+        if (magic != self.Magic or records != record_count or
+            len(body) != entries * self.EntryStruct.size or
+            zlib.crc32(body) != crc):
+            return None
+        index_from_identity = {}
+        last = None
+        for identity, index in self.EntryStruct.iter_unpack(body):
+            key = identity.decode("utf8").rstrip("\x00")
+            if index == self.Deleted:
+                index_from_identity.pop(key, None)
+            else:
+                index_from_identity[key] = index
+                last = key, identity
+        if last is not None and last[0] in index_from_identity:
+            if not self.__matches_data(last[1],
+                                       index_from_identity[last[0]]):
+                return None
+        free = set(range(record_count)) - set(index_from_identity.values())
+        if not self.__all_deleted(free):
+            return None
+        self.__open(entries, crc)
+        return index_from_identity, free
+
+
+    def __matches_data(self, identity, index):
+        # The data file may have been replaced by one with as many
+        # records, so check that the last entry still describes it
+        try:
+            with open(self.data_filename, "rb") as fh:
+                fh.seek(index * _BIKE_STRUCT.size)
+                return fh.read(len(identity)) == identity
+        except EnvironmentError:
+            return False
+
+
+    def __all_deleted(self, free):
+        # A crash after a bike was appended in a deleted position but
+        # before it was logged leaves a bike the index thinks is deleted
+        tombstone = bytes(_BIKE_STRUCT.size)
+        try:
+            with open(self.data_filename, "rb") as fh:
+                for index in sorted(free):
+                    fh.seek(index * _BIKE_STRUCT.size)
+                    if fh.read(_BIKE_STRUCT.size) != tombstone:
+                        return False
+        except EnvironmentError:
+            return False
+        return True
+
+
+    def rewrite(self, index_from_identity, record_count):
+        """Replaces the index with one holding index_from_identity"""
+        self.close()
+        body = b"".join(self.EntryStruct.pack(identity.encode("utf8"),
+                                              index)
+                        for identity, index in sorted(
+                                index_from_identity.items(),
+                                key=lambda item: item[1]))
+        crc = zlib.crc32(body)
+        temporary = self.filename + ".tmp"
+        with open(temporary, "wb") as fh:
+            fh.write(self.HeaderStruct.pack(self.Magic, record_count,
+                                            len(index_from_identity), crc))
+            fh.write(body)
+        os.replace(temporary, self.filename)
+        self.__open(len(index_from_identity), crc)
+
+
+    def __open(self, entries, crc):
+        self.__fh = open(self.filename, "r+b")
+        self.__entries = entries
+        self.__crc = crc
+
+
+    def add(self, identity, index, record_count):
+        """Records that identity's record is at index position index of
+        a data file that now holds record_count records
+        """
+        if self.__fh is None:
+            return
+        entry = self.EntryStruct.pack(identity.encode("utf8"), index)
+        self.__entries += 1
+        self.__crc = zlib.crc32(entry, self.__crc)
+        self.__fh.seek(0, os.SEEK_END)
+        self.__fh.write(entry)
+        self.__fh.seek(0)
+        self.__fh.write(self.HeaderStruct.pack(self.Magic, record_count,
+                                               self.__entries, self.__crc))
+        self.__fh.flush()
+
+
+    def close(self):
+        if self.__fh is not None:
+            self.__fh.close()
+            self.__fh = None
+
+
 class BikeStock:
 
-    def __init__(self, filename):
+    def __init__(self, filename, compact_threshold=0.5, cache_size=1024):
+        """A stock of bikes held in filename
+
+        The index positions of the bikes' records, and so the positions
+        of the deleted ones, are loaded from the sidecar index file
+        filename.idx, or found by reading every record if it is missing
+        or out of date. Only the deleted positions are read, to check
+        that no bike was put in one without being added to the index.
+
+        A deleted bike's record is zeroed (a zeroed record has an empty
+        identity so it cannot be a bike) and its position is reused
+        for the next bike appended, so deleting never moves the other
+        records. Once more than compact_threshold of the positions are
+        deleted the file is compacted and the index positions of the
+        records that moved are updated.
+
+        If a batch of updates was interrupted, it is completed from the
+        journal file filename.journal.
+
+        The records of the cache_size most recently read bikes are
+        kept in memory, so looking up popular bikes again does not
+        read the file.
+
+        The sorted price and name indexes used by
+        identities_priced_between() and identities_named() are only
+        built when one of them is first called, and are kept up to date
+        from then on.
+        """
+        record_count = (os.path.getsize(filename) // _BIKE_STRUCT.size
+                        if os.path.exists(filename) else 0)
+        self.__index = _IdentityIndex(filename + ".idx", filename)
+        loaded = self.__index.load(record_count)
+        self.__index_from_identity, free = loaded or (None, None)
         self.__file = BinaryRecordFile_ans.BinaryRecordFile(filename,
-                                                _BIKE_STRUCT.size)
-        self.__index_from_identity = {}
-        for index in range(len(self.__file)):
-            record = self.__file[index]
-            bike = _bike_from_record(record)
-            self.__index_from_identity[bike.identity] = index
+                _BIKE_STRUCT.size, tombstone=bytes(_BIKE_STRUCT.size),
+                compact_threshold=compact_threshold, cache_size=cache_size,
+                free=free)
+        self.__by_price = self.__by_name = None
+        self.__journal = filename + ".journal"
+        writes = _read_update_journal(self.__journal)
+        if writes is not None:
+            self.__write_all(writes)
+        if os.path.exists(self.__journal):
+            os.remove(self.__journal)
+        self.__file.add_compaction_listener(self.__remap)
+        if self.__index_from_identity is None:
+            self.__index_from_identity = {}
+            for index, record in enumerate(self.__file[:]):
+                if record is not None:
+                    bike = _bike_from_record(record)
+                    self.__index_from_identity[bike.identity] = index
+            self.__index.rewrite(self.__index_from_identity,
+                                 len(self.__file))
 
 
     def close(self):
         "Сloses the file"
         self.__file.close()
+        self.__index.close()
 
 
     def append(self, bike):
         "Adds a new bike to the stock"
-        self.__index_from_identity[bike.identity] = len(self.__file)
-        self.__file.append(_record_from_bike(bike))
+        record = _record_from_bike(bike)
+        index = self.__file.append(record)
+        self.__index_from_identity[bike.identity] = index
+        self.__index.add(bike.identity, index, len(self.__file))
+        self.__add_to_indexes(record)
         
 
     def __delitem__(self, identity):
         "Deletes the stock record for the specified bike"
-        del self.__file[self.__index_from_identity[identity]]
+        index, record = self.__read(identity)
         del self.__index_from_identity[identity]
+        self.__remove_from_indexes(record)
+        # Zero the record before logging the deletion, so that a crash
+        # in between leaves the index naming a zeroed record, which
+        # __read() treats as deleted, rather than a record that is
+        # still a bike but is missing from the index
+        del self.__file[index]
+        self.__index.add(identity, _IdentityIndex.Deleted, len(self.__file))
+
+
+    def compact(self):
+        "Removes the space left by deleted bikes from the file"
+        self.__file.compact()
+
+
+    def __remap(self, moved):
+        for identity, index in self.__index_from_identity.items():
+            if index in moved:
+                self.__index_from_identity[identity] = moved[index]
+        self.__index.rewrite(self.__index_from_identity, len(self.__file))
+
+
+    def __read(self, identity):
+        # Returns the index position and record of the identity's bike
+        index = self.__index_from_identity[identity]
+        record = self.__file[index]
+        if record is None:
+            # The bike was deleted but the deletion was never logged,
+            # so its position is not free yet either
+            del self.__index_from_identity[identity]
+            del self.__file[index]
+            self.__index.add(identity, _IdentityIndex.Deleted,
+                             len(self.__file))
+            raise KeyError(identity)
+        return index, record
 
 
     def __getitem__(self, identity):
         "Retrieves the stock record for the specified bike"
-        record = self.__file[self.__index_from_identity[identity]]
-        return _bike_from_record(record)
+        return _bike_from_record(self.__read(identity)[1])
 
 
     def __change_bike(self, identity, what, value):
-        index = self.__index_from_identity[identity]
-        record = self.__file[index]
+        index, record = self.__read(identity)
         bike = _bike_from_record(record)
         if what == "price":
             bike.price = value
         elif what == "name":
             bike.name = value
-        self.__file[index] = _record_from_bike(bike)
+        self.__remove_from_indexes(record)
+        record = _record_from_bike(bike)
+        self.__file[index] = record
+        self.__add_to_indexes(record)
         return True
 
     change_name = lambda self, identity, name: self.__change_bike(
@@ -222,18 +630,65 @@ class BikeStock:
     change_name.__doc__ = "Changes the bike's name"
 
     change_price = lambda self, identity, price: self.__change_bike(
-                                            identity, "price", name)
+                                            identity, "price", price)
     change_price.__doc__ = "Changes the bike's price"
 
 
     def __change_stock(self, identity, amount):
-        index = self.__index_from_identity[identity]
-        record = self.__file[index]
+        index, record = self.__read(identity)
         bike = _bike_from_record(record)
         bike.quantity += amount
         self.__file[index] = _record_from_bike(bike)
         return True
         
+    def apply_updates(self, deltas):
+        """Changes the stock held of every bike in the dict deltas by
+        the amount it maps the bike's identity to, as one batch
+
+        Either every change is made or, if any bike is unknown or would
+        have a negative quantity, none is. The new records are written
+        in file order, each run of adjacent records with one write, and
+        are journalled first so that a batch interrupted by a crash is
+        completed when the stock is next opened.
+        """
+        writes = sorted(self.__read(identity) + (amount,)
+                        for identity, amount in deltas.items())
+        for i, (index, record, amount) in enumerate(writes):
+            identity, name, quantity, price = _BIKE_STRUCT.unpack(record)
+            quantity += amount
+            assert 0 <= quantity, "quantity must not be negative"
+            writes[i] = (index, _BIKE_STRUCT.pack(identity, name,
+                                                  quantity, price))
+        if not writes:
+            return
+        _write_update_journal(self.__journal, writes)
+        self.__write_all(writes)
+        os.remove(self.__journal)
+
+
+    @contextlib.contextmanager
+    def updates(self):
+        """A context manager that gives a dict in which to add up the
+        stock changes of, say, a delivery; they are applied with
+        apply_updates() when the with block ends without an exception
+        """
+        deltas = collections.defaultdict(int)
+        yield deltas
+        self.apply_updates(deltas)
+
+
+    def __write_all(self, writes):
+        # writes is a list of (index, record) pairs sorted by index
+        start = 0
+        for i in range(1, len(writes) + 1):
+            if i == len(writes) or writes[i][0] != writes[i - 1][0] + 1:
+                first = writes[start][0]
+                self.__file[first:first + i - start] = [
+                        record for index, record in writes[start:i]]
+                start = i
+        self.__file.sync()
+
+
     increase_stock = (lambda self, identity, amount:
                                 self.__change_stock(identity, amount))
     increase_stock.__doc__ = ("Increases the stock held for the "
@@ -246,12 +701,111 @@ class BikeStock:
 
         
     def __iter__(self):
-        for index in range(len(self.__file)):
-            record = self.__file[index]
+        for record in self.__file[:]:
             if record is not None:
                 yield _bike_from_record(record)
 
 
+    def total_value(self):
+        "The value of all the bikes in stock"
+        return sum(quantity * price
+                   for identity, name, quantity, price in self.__scan())
+
+
+    def total_quantity(self, prefix=""):
+        """How many bikes are in stock in total, counting only those
+        whose identity starts with prefix
+        """
+        prefix = prefix.encode("utf8")
+        return sum(quantity
+                   for identity, name, quantity, price in self.__scan()
+                   if identity.startswith(prefix))
+
+
+    def bikes_below(self, quantity):
+        """Returns the identities of the bikes of which fewer than
+        quantity are in stock
+        """
+        return [identity.decode("utf8").rstrip("\x00")
+                for identity, name, stock, price in self.__scan()
+                if stock < quantity and identity[0]]
+
+
+    def identities_priced_between(self, low, high):
+        """Returns the identities of the bikes priced from low to high
+        inclusive, cheapest first
+        """
+        self.__build_indexes()
+        start = bisect.bisect_left(self.__by_price, (low,))
+        end = bisect.bisect_right(self.__by_price, (high, "\U0010FFFF"),
+                                  start)
+        return [identity for price, identity in self.__by_price[start:end]]
+
+
+    def identities_named(self, prefix):
+        """Returns the identities of the bikes whose names start with
+        prefix, ignoring case, in order of name
+        """
+        self.__build_indexes()
+        prefix = prefix.casefold()
+        start = bisect.bisect_left(self.__by_name, (prefix,))
+        end = bisect.bisect_left(self.__by_name, (prefix + "\U0010FFFF",),
+                                 start)
+        return [identity for name, identity in self.__by_name[start:end]]
+
+
+    def __build_indexes(self):
+        if self.__by_price is not None:
+            return
+        self.__by_price = []
+        self.__by_name = []
+        for identity, name, quantity, price in self.__scan():
+            if identity[0]:
+                identity = identity.decode("utf8").rstrip("\x00")
+                name = name.decode("utf8").rstrip("\x00").casefold()
+                self.__by_price.append((price, identity))
+                self.__by_name.append((name, identity))
+        self.__by_price.sort()
+        self.__by_name.sort()
+
+
+    def __index_keys(self, record):
+        identity, name, quantity, price = _BIKE_STRUCT.unpack(record)
+        identity = identity.decode("utf8").rstrip("\x00")
+        name = name.decode("utf8").rstrip("\x00").casefold()
+        return (price, identity), (name, identity)
+
+
+    def __add_to_indexes(self, record):
+        if self.__by_price is not None:
+            by_price, by_name = self.__index_keys(record)
+            bisect.insort(self.__by_price, by_price)
+            bisect.insort(self.__by_name, by_name)
+
+
+    def __remove_from_indexes(self, record):
+        if self.__by_price is not None:
+            for entries, key in zip((self.__by_price, self.__by_name),
+                                    self.__index_keys(record)):
+                del entries[bisect.bisect_left(entries, key)]
+
+
+    def __scan(self):
+        # Yields the unpacked fields of every record, reading many
+        # records at a time and creating no Bikes; deleted records are
+        # zeroed so they have no quantity or value and an empty identity
+        size = _BIKE_STRUCT.size
+        buffer = bytearray(min(len(self.__file), _SCAN_RECORDS) * size)
+        start = 0
+        while True:
+            count = self.__file.read_into(buffer, start)
+            if not count:
+                break
+            with memoryview(buffer) as view:
+                yield from _BIKE_STRUCT.iter_unpack(view[:count * size])
+            start += count
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Times opening a BikeStock and a mix of deletes and lookups
+
+Fills a temporary stock file with bikes and times opening it with its
+sidecar identity index and, after removing the index, by reading every
+record. Then times totalling the stock's value by iterating over Bikes
+and with total_value(), restocking many bikes one at a time and with
+apply_updates(), looking up a small set of popular bikes over and over
+with and without the record cache, and a random mix of deletes and
+lookups with BikeStock's tombstone deletes and with records shifted
+down by each delete (as BinaryRecordFile does without a tombstone) and
+the identity map fixed up to match.
+"""
+
+import optparse
+import os
+import random
+import tempfile
+import time
+import BikeStock_ans
+import BinaryRecordFile_ans
+
+
+def main():
+    opts = parse_options()
+    filename = os.path.join(tempfile.gettempdir(), "bench-bikes.dat")
+    remove(filename)
+    try:
+        stock = BikeStock_ans.BikeStock(filename)
+        for bike in make_bikes(opts.bikes):
+            stock.append(bike)
+        stock.close()
+        print("{0:>12} {1:>10}".format("open", "seconds"))
+        print("{0:>12} {1:>10.3f}".format("with index",
+                                          timed_open(filename)))
+        os.remove(filename + ".idx")
+        print("{0:>12} {1:>10.3f}".format("full scan",
+                                          timed_open(filename)))
+        stock = BikeStock_ans.BikeStock(filename)
+        print("{0:>12} {1:>10}".format("total value", "seconds"))
+        for name, function in (
+                ("Bikes", lambda: sum(bike.value for bike in stock)),
+                ("total_value", stock.total_value)):
+            start = time.perf_counter()
+            function()
+            print("{0:>12} {1:>10.3f}".format(name,
+                  time.perf_counter() - start))
+        random.seed(opts.bikes)
+        deltas = {"B{0:07d}".format(i): random.randint(1, 10)
+                  for i in random.sample(range(opts.bikes),
+                                         min(opts.updates, opts.bikes))}
+        print("{0:>12} {1:>10}".format("restock", "seconds"))
+        start = time.perf_counter()
+        for identity, amount in deltas.items():
+            stock.increase_stock(identity, amount)
+        print("{0:>12} {1:>10.3f}".format("one by one",
+              time.perf_counter() - start))
+        start = time.perf_counter()
+        stock.apply_updates(deltas)
+        print("{0:>12} {1:>10.3f}".format("batch", time.perf_counter() -
+                                                  start))
+        stock.close()
+        popular = ["B{0:07d}".format(i) for i in
+                   random.sample(range(opts.bikes), min(100, opts.bikes))]
+        lookups = [random.choice(popular) for _ in range(opts.operations)]
+        print("{0:>12} {1:>10}".format("lookups", "ops/s"))
+        for name, cache_size in (("uncached", 0), ("cached", 1024)):
+            stock = BikeStock_ans.BikeStock(filename, cache_size=cache_size)
+            start = time.perf_counter()
+            for identity in lookups:
+                stock[identity]
+            print("{0:>12} {1:>10.0f}".format(name, len(lookups) /
+                  (time.perf_counter() - start)))
+            stock.close()
+        operations = make_operations(opts.bikes, opts.operations,
+                                     opts.deletes)
+        print("{0:>12} {1:>10}".format("deletes", "ops/s"))
+        for name, workload in (("tombstone", tombstone_workload),
+                               ("shifting", shifting_workload)):
+            remove(filename)
+            stock = BikeStock_ans.BikeStock(filename)
+            for bike in make_bikes(opts.bikes):
+                stock.append(bike)
+            stock.close()
+            print("{0:>12} {1:>10.0f}".format(name, len(operations) /
+                  workload(filename, operations)))
+    finally:
+        remove(filename)
+
+
+def parse_options():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--bikes", dest="bikes", default=100000,
+            type="int",
+            help="the number of bikes in the stock [default %default]")
+    parser.add_option("-u", "--updates", dest="updates", default=5000,
+            type="int",
+            help="the number of bikes restocked [default %default]")
+    parser.add_option("-o", "--operations", dest="operations",
+            default=20000, type="int",
+            help="the number of deletes and lookups [default %default]")
+    parser.add_option("-d", "--deletes", dest="deletes", default=10,
+            type="int",
+            help="the percentage of operations that are deletes "
+                 "[default %default]")
+    opts, args = parser.parse_args()
+    return opts
+
+
+def make_bikes(count):
+    for i in range(count):
+        yield BikeStock_ans.Bike("B{0:07d}".format(i),
+                                 "Bike model {0}".format(i % 1000),
+                                 i % 50, 100.0 + i % 400)
+
+
+def make_operations(count, operations, deletes):
+    """Returns a list of ("delete" or "lookup", identity) pairs"""
+    random.seed(count)
+    identities = ["B{0:07d}".format(i) for i in range(count)]
+    result = []
+    for i in range(operations):
+        if random.randrange(100) < deletes and len(identities) > 1:
+            identity = identities.pop(random.randrange(len(identities)))
+            result.append(("delete", identity))
+        else:
+            result.append(("lookup", random.choice(identities)))
+    return result
+
+
+def tombstone_workload(filename, operations):
+    """Returns how many seconds the operations took"""
+    stock = BikeStock_ans.BikeStock(filename)
+    start = time.perf_counter()
+    for operation, identity in operations:
+        if operation == "delete":
+            del stock[identity]
+        else:
+            assert stock[identity].identity == identity
+    elapsed = time.perf_counter() - start
+    stock.close()
+    return elapsed
+
+
+def shifting_workload(filename, operations):
+    """Returns how many seconds the operations took"""
+    brf = BinaryRecordFile_ans.BinaryRecordFile(filename,
+            BikeStock_ans._BIKE_STRUCT.size)
+    index_from_identity = {}
+    for index, record in enumerate(brf[:]):
+        index_from_identity[
+                BikeStock_ans._bike_from_record(record).identity] = index
+    start = time.perf_counter()
+    for operation, identity in operations:
+        if operation == "delete":
+            deleted = index_from_identity.pop(identity)
+            del brf[deleted]
+            for other, index in index_from_identity.items():
+                if index > deleted:
+                    index_from_identity[other] = index - 1
+        else:
+            bike = BikeStock_ans._bike_from_record(
+                    brf[index_from_identity[identity]])
+            assert bike.identity == identity
+    elapsed = time.perf_counter() - start
+    brf.close()
+    return elapsed
+
+
+def remove(filename):
+    for name in (filename, filename + ".idx"):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def timed_open(filename):
+    start = time.perf_counter()
+    BikeStock_ans.BikeStock(filename).close()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
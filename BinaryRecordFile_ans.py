@@ -85,23 +85,221 @@ True
 >>> test.close()
 >>> os.path.getsize(filename)
 40
+
+>>> test = BinaryRecordFile(filename, S.size, use_mmap=True)
+>>> bytes(test[4]).rstrip(bytes(1))
+b'Echo'
+>>> test.append(S.pack(b"Foxtrot"))
+>>> test[1] = S.pack(b"Bravo 2")
+>>> [bytes(test[i]).rstrip(bytes(1)) for i in (1, 5)]
+[b'Bravo 2', b'Foxtrot']
+>>> view = test[0]
+>>> del test[0] # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+BufferError: records are still in use
+>>> view.release()
+>>> del test[0]
+>>> len(test), S.unpack(test[0])[0].rstrip(bytes(1))
+(5, b'Bravo 2')
+>>> test.close()
+>>> os.path.getsize(filename)
+40
+>>> os.remove(filename)
+
+>>> moves = []
+>>> test = BinaryRecordFile(filename, S.size, tombstone=bytes(S.size))
+>>> test.add_compaction_listener(moves.append)
+>>> for text in (b"Alpha", b"Bravo", b"Charlie", b"Delta", b"Echo"):
+...     index = test.append(S.pack(text))
+>>> del test[1]
+>>> del test[3]
+>>> test[1] is None, len(test), test.deleted
+(True, 5, 2)
+>>> del test[1] # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+IndexError: no record at index position 1
+>>> test.append(S.pack(b"Foxtrot")) in (1, 3)
+True
+>>> test.compact()
+{4: 3}
+>>> moves
+[{4: 3}]
+>>> [S.unpack(test[i])[0].rstrip(bytes(1)) for i in range(len(test))]
+[b'Alpha', b'Foxtrot', b'Charlie', b'Echo']
+>>> test.close()
+>>> os.path.getsize(filename)
+32
+>>> os.remove(filename)
+>>> test = BinaryRecordFile(filename, S.size, use_mmap=True,
+...                         tombstone=bytes(S.size))
+>>> for text in (b"Alpha", b"Bravo", b"Charlie", b"Delta", b"Echo"):
+...     index = test.append(S.pack(text))
+>>> del test[1]
+>>> del test[3]
+>>> test.compact()
+{2: 1, 4: 2}
+>>> test.append(S.pack(b"Foxtrot")), len(test)
+(3, 4)
+>>> test.close()
+>>> os.path.getsize(filename)
+32
+>>> test = BinaryRecordFile(filename, S.size, tombstone=bytes(S.size),
+...                         free=[2])
+>>> test.deleted, test.append(S.pack(b"Golf")), len(test)
+(1, 2, 4)
+>>> test.close()
+>>> test = BinaryRecordFile(filename, S.size, tombstone=bytes(S.size),
+...                         compact_threshold=0.5)
+>>> del test[0]
+>>> del test[1]
+>>> len(test), test.deleted
+(4, 2)
+>>> del test[2]
+>>> len(test), test.deleted
+(1, 0)
+>>> test.close()
+>>> os.remove(filename)
+
+>>> test = BinaryRecordFile(filename, S.size, auto_flush=False,
+...                         buffer_size=3, durability="close")
+>>> test.append(S.pack(b"Alpha"))
+>>> test.append(S.pack(b"Bravo"))
+>>> len(test), os.path.getsize(filename)
+(2, 0)
+>>> test[1] = S.pack(b"Bravo 2")
+>>> S.unpack(test[1])[0].rstrip(bytes(1))
+b'Bravo 2'
+>>> test.append(S.pack(b"Charlie"))
+>>> os.path.getsize(filename)
+24
+>>> test.close()
+>>> os.remove(filename)
+
+>>> test = BinaryRecordFile(filename, S.size)
+>>> test.extend(S.pack(text) for text in (b"Alpha", b"Bravo", b"Charlie",
+...                                       b"Delta", b"Echo"))
+>>> [S.unpack(record)[0].rstrip(bytes(1)) for record in test[1:4]]
+[b'Bravo', b'Charlie', b'Delta']
+>>> test[3:5] = [S.pack(b"Delta 2"), S.pack(b"Echo 2")]
+>>> len(test[::2]), S.unpack(test[-1:][0])[0].rstrip(bytes(1))
+(3, b'Echo 2')
+>>> buffer = bytearray(3 * S.size)
+>>> test.read_into(buffer, 3)
+2
+>>> bytes(buffer[S.size:2 * S.size]).rstrip(bytes(1))
+b'Echo 2'
+>>> test.close()
+>>> mapped = BinaryRecordFile(filename, S.size, use_mmap=True,
+...                           auto_flush=False)
+>>> mapped[4] is not None
+True
+>>> mapped.extend([S.pack(b"Foxtrot"), S.pack(b"Golf")])
+>>> mapped[4:6] = [S.pack(b"Echo 3"), S.pack(b"Foxtrot 3")]
+>>> bytes(mapped[4]).rstrip(bytes(1))
+b'Echo 3'
+>>> mapped.close()
+>>> os.remove(filename)
+
+>>> test = BinaryRecordFile(filename, S.size, cache_size=2)
+>>> test[0:0] = []
+>>> test.extend(S.pack(text) for text in (b"Alpha", b"Bravo", b"Charlie"))
+>>> test[1:1] = []
+>>> len(test)
+3
+>>> [S.unpack(test[i])[0].rstrip(bytes(1)) for i in (0, 1, 0, 2, 1)]
+[b'Alpha', b'Bravo', b'Alpha', b'Charlie', b'Bravo']
+>>> test.cache_hits, test.cache_misses
+(1, 4)
+>>> test[1] = S.pack(b"Bravo 2")
+>>> S.unpack(test[1])[0].rstrip(bytes(1)), test.cache_misses
+(b'Bravo 2', 5)
+>>> del test[0]
+>>> S.unpack(test[0])[0].rstrip(bytes(1)), test.cache_misses
+(b'Bravo 2', 6)
+>>> test.close()
 >>> os.remove(filename)
 """
 
+import collections
+import mmap
 import os
 import struct
 
 
 class BinaryRecordFile:
 
-    def __init__(self, filename, record_size, auto_flush=True):
+    def __init__(self, filename, record_size, auto_flush=True,
+                 use_mmap=False, tombstone=None, compact_threshold=None,
+                 buffer_size=256, durability="none", cache_size=0,
+                 free=None):
         """A random access binary file that behaves rather like a list
         with each item a bytes or bytesarray object of record_size.
+
+        Unless auto_flush is True, writes are held in a write-behind
+        buffer of up to buffer_size records and written in runs of
+        adjacent records when it fills or flush() is called.
+        durability says when writes are also fsync'd: "none" (never),
+        "close", "fsync" (after every write) or an int N (after every N
+        writes).
+
+        If use_mmap is True the file is memory-mapped and items are
+        returned as read-only memoryview slices of the map instead of
+        being read into new bytes objects. A view stays valid until its
+        record is deleted, so no record may be deleted while views are
+        held: release() them or copy them with bytes() first.
+
+        If cache_size is given (and use_mmap is False, since reading
+        from a map needs no system calls) up to cache_size of the most
+        recently read records are kept in memory so that reading them
+        again does not touch the file. Writes and deletes keep the
+        cache up to date.
+
+        If tombstone is given (a record that is never stored as data)
+        records are deleted by overwriting them with it rather than by
+        moving every later record down. A deleted record's item is None,
+        and its position is reused by the next append(). compact()
+        reclaims the space, and is called automatically after a delete
+        that leaves more than compact_threshold (a fraction of len())
+        of the positions deleted if compact_threshold is given. The
+        deleted positions are found by reading every record unless
+        they are given as the iterable free.
         """
+        assert (durability in {"none", "close", "fsync"} or
+                (isinstance(durability, int) and durability > 0)), (
+                "invalid durability {0!r}".format(durability))
         self.__record_size = record_size
         mode = "w+b" if not os.path.exists(filename) else "r+b"
         self.__fh = open(filename, mode)
         self.auto_flush = auto_flush
+        self.buffer_size = buffer_size
+        self.__durability = durability
+        self.__pending = {}
+        self.__unsynced = 0
+        self.__use_mmap = use_mmap
+        self.__map = self.__view = None
+        self.__mapped_end = 0
+        self.__cache = (collections.OrderedDict()
+                        if cache_size and not use_mmap else None)
+        self.__cache_size = cache_size
+        self.cache_hits = self.cache_misses = 0
+        self.__end = os.path.getsize(filename)
+        self.__tombstone = tombstone
+        self.compact_threshold = compact_threshold
+        self.__listeners = []
+        self.__free = set()
+        if tombstone is not None:
+            assert len(tombstone) == record_size, (
+                "tombstone must be exactly {0} bytes".format(record_size))
+        if tombstone is not None and free is not None:
+            self.__free.update(free)
+        elif tombstone is not None:
+            for start in range(0, len(self), 4096):
+                for index, record in enumerate(self[start:start + 4096],
+                                               start):
+                    if record is None:
+                        self.__free.add(index)
 
 
     @property
@@ -110,6 +308,30 @@ class BinaryRecordFile:
         return self.__record_size
 
 
+    @property
+    def use_mmap(self):
+        "Whether the file is memory-mapped"
+        return self.__use_mmap
+
+
+    @property
+    def durability(self):
+        "When writes are fsync'd"
+        return self.__durability
+
+
+    @property
+    def deleted(self):
+        "The number of deleted records waiting to be reused or compacted"
+        return len(self.__free)
+
+
+    @property
+    def cache_size(self):
+        "The most records kept in the read cache"
+        return self.__cache_size if self.__cache is not None else 0
+
+
     @property
     def name(self):
         "The name of the file"
@@ -120,67 +342,306 @@ class BinaryRecordFile:
         """Flush writes to disk
         Done automatically if auto_flush is True
         """
+        self.__write_pending()
         self.__fh.flush()
 
 
+    def sync(self):
+        """Flushes writes and waits until they are on the disk"""
+        self.flush()
+        if self.__map is not None:
+            self.__map.flush()
+        os.fsync(self.__fh.fileno())
+        self.__unsynced = 0
+
+
     def close(self):
+        if self.__durability == "none":
+            self.flush()
+        else:
+            self.sync()
+        self.__unmap()
         self.__fh.close()
 
 
+    def add_compaction_listener(self, listener):
+        """Arranges for listener to be called with the dict that
+        compact() returns whenever records are moved by compaction
+        """
+        self.__listeners.append(listener)
+
+
     def append(self, record):
-        """Appends new record in end"""
-        assert isinstance(record, (bytes, bytearray)), \
-            "binary data required"
-        assert len(record) == self.record_size, (
-            "record must be exactly {0} bytes".format(
-            self.record_size))
-        self.__fh.seek(0, os.SEEK_END)
-        self.__fh.write(record)
+        """Appends new record in end
+
+        If a tombstone is used, the record goes in the position of a
+        deleted record if there is one, and its index position is
+        returned.
+        """
+        self.__check(record)
+        if self.__free:
+            index = self.__free.pop()
+            self.__write(index, record)
+            return index
+        index = len(self)
+        self.__end += self.record_size
+        self.__write(index, record)
+        if self.__tombstone is not None:
+            return index
+
+
+    def extend(self, records):
+        """Appends every record in records in end with a single write"""
+        records = list(records)
+        for record in records:
+            self.__check(record)
+        self.flush()
+        self.__fh.seek(self.__end)
+        self.__fh.write(b"".join(records))
         if self.auto_flush:
             self.__fh.flush()
+        self.__end += len(records) * self.record_size
+        self.__written(len(records))
 
 
     def __setitem__(self, index, record):
         """Sets the item at position index to be the given record
 
         The index position can be beyond the current end of the file.
+        If index is a slice with a step of 1, record must be a sequence
+        of as many records as the slice covers, and they are written
+        with a single write.
         """
+        if isinstance(index, slice):
+            self.__set_slice(index, record)
+            return
+        self.__check(record)
+        self.__check_index(index)
+        self.__free.discard(index)
+        self.__write(index, record)
+
+
+    def __check(self, record):
         assert isinstance(record, (bytes, bytearray)), \
                "binary data required"
         assert len(record) == self.record_size, (
             "record must be exactly {0} bytes".format(
             self.record_size))
-        self.__seek_to_index(index)
-        self.__fh.write(record)
-        if self.auto_flush:
-            self.__fh.flush()
+        assert record != self.__tombstone, \
+               "the tombstone cannot be stored"
+
+
+    def __check_index(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError("no record at index position {0}".format(
+                             index))
+
+
+    def __write(self, index, record):
+        if self.__cache is not None:
+            self.__cache.pop(index, None)
+        offset = index * self.record_size
+        if offset + self.record_size <= min(self.__end, self.__mapped_end):
+            self.__map[offset:offset + self.record_size] = record
+        else:
+            self.__pending[index] = bytes(record)
+            if self.auto_flush or len(self.__pending) >= self.buffer_size:
+                self.flush()
+        self.__written(1)
+
+
+    def __set_slice(self, index, records):
+        start, stop, step = index.indices(len(self))
+        records = list(records)
+        assert step == 1 and len(records) == stop - start, (
+               "slice assignment must replace a run of records with as "
+               "many records")
+        if not records:
+            return
+        for record in records:
+            self.__check(record)
+        for i in range(start, stop):
+            self.__free.discard(i)
+            if self.__cache is not None:
+                self.__cache.pop(i, None)
+        offset = start * self.record_size
+        data = b"".join(records)
+        if offset + len(data) <= self.__mapped_end:
+            self.__map[offset:offset + len(data)] = data
+        else:
+            self.flush()
+            self.__fh.seek(offset)
+            self.__fh.write(data)
+            if self.auto_flush or self.__map is not None:
+                # Reads of records within the map must see the write
+                self.__fh.flush()
+        self.__written(len(records))
+
+
+    def __written(self, count):
+        self.__unsynced += count
+        if (self.__durability == "fsync" or
+            (isinstance(self.__durability, int) and
+             self.__unsynced >= self.__durability)):
+            self.sync()
+
+
+    def __write_pending(self):
+        # Each run of adjacent records is written with a single write
+        if not self.__pending:
+            return
+        indexes = sorted(self.__pending)
+        start = 0
+        for i in range(1, len(indexes) + 1):
+            if i == len(indexes) or indexes[i] != indexes[i - 1] + 1:
+                self.__fh.seek(indexes[start] * self.record_size)
+                self.__fh.write(b"".join(self.__pending[index]
+                                         for index in indexes[start:i]))
+                start = i
+        self.__pending.clear()
 
 
     def __getitem__(self, index):
         """Returns the item at the given index position
 
         If there is no item at the given position, raises an
-        IndexError exception.
+        IndexError exception. The item of a deleted record is None.
+        If index is a slice, returns a list of the items it covers,
+        read with a single read.
         """
-        self.__seek_to_index(index)
-        return self.__fh.read(self.record_size)
-        
-
-    def __seek_to_index(self, index):
-        if self.auto_flush:
-            self.__fh.flush()
-        self.__fh.seek(0, os.SEEK_END)
-        end = self.__fh.tell()
-        offset = index * self.__record_size
-        if offset >= end:
+        if isinstance(index, slice):
+            return self.__get_slice(index)
+        record = self.__read(index)
+        if self.__tombstone is not None and record == self.__tombstone:
+            return None
+        return record
+
+
+    def __get_slice(self, index):
+        start, stop, step = index.indices(len(self))
+        if step < 0:
+            return self[slice(stop + 1, start + 1)][::step]
+        size = self.__record_size
+        if start >= stop:
+            return []
+        if self.__use_mmap:
+            if stop * size > self.__mapped_end:
+                self.__remap()
+            data = self.__view
+            base = 0
+        else:
+            self.flush()
+            self.__fh.seek(start * size)
+            data = self.__fh.read((stop - start) * size)
+            base = start * size
+        records = [data[offset - base:offset - base + size]
+                   for offset in range(start * size, stop * size,
+                                       step * size)]
+        if self.__tombstone is not None:
+            records = [None if record == self.__tombstone else record
+                       for record in records]
+        return records
+
+
+    def read_into(self, buffer, start=0, count=None):
+        """Reads up to count records (as many as fit into buffer if
+        count is None) from index position start into the writable
+        buffer with a single read and returns how many were read
+
+        Deleted records are read as the tombstone.
+        """
+        size = self.__record_size
+        view = memoryview(buffer).cast("B")
+        if count is None:
+            count = len(view) // size
+        count = max(0, min(count, len(view) // size, len(self) - start))
+        if count:
+            if self.__use_mmap:
+                if (start + count) * size > self.__mapped_end:
+                    self.__remap()
+                view[:count * size] = self.__view[start * size:
+                                                  (start + count) * size]
+            else:
+                self.flush()
+                self.__fh.seek(start * size)
+                self.__fh.readinto(view[:count * size])
+        view.release()
+        return count
+
+
+    def __read(self, index):
+        size = self.__record_size
+        offset = index * size
+        if not 0 <= offset < self.__end:
             raise IndexError("no record at index position {0}".format(
                              index))
+        if self.__pending:
+            record = self.__pending.get(index)
+            if record is not None:
+                return record
+        if self.__use_mmap:
+            if offset + size > self.__mapped_end:
+                self.__remap()
+            return self.__view[offset:offset + size]
+        cache = self.__cache
+        if cache is not None:
+            record = cache.get(index)
+            if record is not None:
+                cache.move_to_end(index)
+                self.cache_hits += 1
+                return record
+            self.cache_misses += 1
         self.__fh.seek(offset)
+        record = self.__fh.read(size)
+        if cache is not None:
+            cache[index] = record
+            if len(cache) > self.__cache_size:
+                cache.popitem(last=False)
+        return record
+
+
+    def __remap(self):
+        # Appends go through the file handle, so the map only needs
+        # replacing when a read reaches past its end
+        self.__unmap()
+        self.flush()
+        self.__map = mmap.mmap(self.__fh.fileno(), 0)
+        self.__view = memoryview(self.__map).toreadonly()
+        self.__mapped_end = len(self.__map)
+
+
+    def __unmap(self, strict=False):
+        if self.__map is None:
+            return
+        self.__view.release()
+        try:
+            self.__map.close()
+        except BufferError:
+            # Views of records are still held; they keep the old map
+            # alive, which is harmless unless the file is to shrink
+            if strict:
+                self.__view = memoryview(self.__map).toreadonly()
+                raise BufferError("records are still in use") from None
+        self.__map = self.__view = None
+        self.__mapped_end = 0
 
 
     def __delitem__(self, index):
         """Deletes the item at the given index position."""
-        self.__seek_to_index(index)
+        if self.__tombstone is not None:
+            if index in self.__free:
+                raise IndexError("no record at index position {0}".format(
+                                 index))
+            self.__check_index(index)
+            self.__write(index, self.__tombstone)
+            self.__free.add(index)
+            if (self.compact_threshold is not None and
+                len(self.__free) > self.compact_threshold * len(self)):
+                self.compact()
+            return
+        self.__check_index(index)
+        self.__unmap(strict=True)
+        self.flush()
         offset = (index + 1) * self.__record_size
         self.__fh.seek(offset)
         next_items = self.__fh.read()
@@ -189,6 +650,41 @@ class BinaryRecordFile:
         self.__fh.write(next_items)
         self.__fh.truncate()
         self.__fh.flush()
+        self.__end -= self.record_size
+        if self.__cache is not None:
+            self.__cache.clear()
+
+
+    def compact(self):
+        """Removes the deleted records, moving later records down to
+        fill their positions, and returns a dict mapping the old index
+        position of every record that moved to its new one
+
+        The dict is also passed to every compaction listener.
+        """
+        self.__unmap(strict=True)
+        moved = {}
+        end = 0
+        for index in range(len(self)):
+            if index in self.__free:
+                continue
+            if index != end:
+                self.__write(end, self.__read(index))
+                moved[index] = end
+            end += 1
+        # Reading the records remapped the file, and the map must not
+        # outlive the truncation
+        self.__unmap(strict=True)
+        self.flush()
+        self.__fh.truncate(end * self.record_size)
+        self.__fh.flush()
+        self.__end = end * self.record_size
+        self.__free.clear()
+        if self.__cache is not None:
+            self.__cache.clear()
+        for listener in self.__listeners:
+            listener(moved)
+        return moved
 
 
     def __len__(self):
@@ -198,11 +694,7 @@ class BinaryRecordFile:
         present. The true number may be less because some records
         might be deleted.
         """
-        if self.auto_flush:
-            self.__fh.flush()
-        self.__fh.seek(0, os.SEEK_END)
-        end = self.__fh.tell()
-        return end // self.__record_size
+        return self.__end // self.__record_size
 
 
 if __name__ == "__main__":
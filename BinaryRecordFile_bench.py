@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Compares the ways BinaryRecordFile can read records
+
+Fills a temporary file with records and times appending them one at a
+time and all at once with extend(), reading them one at a time in
+sequential and in random order and all at once with a slice, and
+overwriting them all in random order, through the file handle and
+through a memory map, with and without auto_flush.
+"""
+
+import optparse
+import os
+import random
+import struct
+import tempfile
+import time
+import BinaryRecordFile_ans
+
+
+def main():
+    opts = parse_options()
+    record = struct.Struct("<{0}s".format(opts.size))
+    records = [record.pack(str(i).encode("ascii"))
+               for i in range(opts.records)]
+    filename = os.path.join(tempfile.gettempdir(), "bench.dat")
+    indexes = list(range(opts.records))
+    shuffled = indexes[:]
+    random.shuffle(shuffled)
+    print("{0:>18} {1:>12} {2:>12} {3:>12} {4:>12} {5:>12} "
+          "{6:>12}".format("mode", "append/s", "extend/s", "sequential/s",
+                           "slice/s", "random/s", "update/s"))
+    for mode, options in (("file", dict()),
+                          ("file buffered", dict(auto_flush=False)),
+                          ("mmap", dict(use_mmap=True)),
+                          ("mmap buffered", dict(use_mmap=True,
+                                                 auto_flush=False))):
+        if os.path.exists(filename):
+            os.remove(filename)
+        try:
+            brf = BinaryRecordFile_ans.BinaryRecordFile(filename,
+                                                        record.size,
+                                                        **options)
+            rates = [timed(lambda: [brf.append(item) for item in records],
+                           len(records)),
+                     timed(lambda: brf.extend(records), len(records)),
+                     timed(lambda: [brf[index] for index in indexes],
+                           len(indexes)),
+                     timed(lambda: brf[:len(records)], len(records)),
+                     timed(lambda: [brf[index] for index in shuffled],
+                           len(shuffled))]
+            rates.append(timed(lambda: [brf.__setitem__(index,
+                                                        records[index])
+                                        for index in shuffled],
+                               len(shuffled)))
+            brf.close()
+        finally:
+            os.remove(filename)
+        print("{0:>18} {1:>12.0f} {2:>12.0f} {3:>12.0f} {4:>12.0f} "
+              "{5:>12.0f} {6:>12.0f}".format(mode, *rates))
+
+
+def parse_options():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--records", dest="records", default=100000,
+            type="int",
+            help="the number of records in the file [default %default]")
+    parser.add_option("-s", "--size", dest="size", default=50, type="int",
+            help="the size of each record in bytes [default %default]")
+    opts, args = parser.parse_args()
+    return opts
+
+
+def timed(function, count):
+    """Returns how many times per second function does count things"""
+    start = time.perf_counter()
+    function()
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
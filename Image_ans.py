@@ -35,12 +35,96 @@ an image. A method to export the image in XPM format is also provided.
 ...             image[x, y] = square_color
 >>> print(image.width, image.height, len(image.colors), image.background)
 240 60 3 #F0F0F0
+>>> for dense in (False, True):
+...     fast = Image(width, height, img, "#F0F0F0", dense=dense)
+...     fast.fill_rect(0, 0, width, height, border_color)
+...     fast.fill_rect(5, 5, width - 5, height - 5, fast.background)
+...     fast.fill_rect(midx - 19, midy - 19, midx + 20, midy + 20,
+...                    square_color)
+...     print(all(fast[x, y] == image[x, y] for x in range(width)
+...               for y in range(height)), len(fast.colors))
+True 3
+True 3
+>>> fast.fill_rect(0, 0, width + 1, 1, red) # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+CoordinateError: (0, 0, 241, 1)
+>>> icon = Image(3, 2, background="#00FF00")
+>>> icon.set_many([(0, 0), (2, 1)], red)
+>>> icon.fill_mask([[True, False], bytes([0, 1])], blue, 1)
+>>> [icon[x, y] for y in range(2) for x in range(3)]
+['#FF0000', '#0000FF', '#00FF00', '#00FF00', '#00FF00', '#0000FF']
+>>> icon.set_many([(1, 0), (3, 0)], red) # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+CoordinateError: (3, 0)
+>>> for dense in (False, True):
+...     target = Image(5, 3, dense=dense)
+...     target.blit(icon, 2, 1)
+...     print([target[x, 1] for x in range(5)], target[2, 0])
+['#FFFFFF', '#FFFFFF', '#FF0000', '#0000FF', '#00FF00'] #FFFFFF
+['#FFFFFF', '#FFFFFF', '#FF0000', '#0000FF', '#00FF00'] #FFFFFF
 >>> image.save()
 >>> newimage = Image(1, 1, img)
 >>> newimage.load()
 >>> print(newimage.width, newimage.height, len(newimage.colors), newimage.background)
 240 60 3 #F0F0F0
 >>> image.export(xpm)
+>>> dense = Image(width, height, img, "#F0F0F0", dense=True)
+>>> dense[0, 0] = border_color
+>>> dense[midx, midy] = square_color
+>>> del dense[0, 0]
+>>> dense[0, 0], dense[midx, midy], dense.dense, len(dense.colors)
+('#F0F0F0', '#0000FF', True, 2)
+>>> dense.save()
+>>> newimage = Image(1, 1, img, dense=True)
+>>> newimage.load()
+>>> newimage.dense, newimage[midx, midy], newimage.width
+(True, '#0000FF', 240)
+>>> image.save()
+>>> part = Image(1, 1, img)
+>>> part.load_rows(28, 32)
+>>> part.width, part.height, part[0, 0], part[6, 0], part[midx, 2]
+(240, 4, '#FF0000', '#F0F0F0', '#0000FF')
+>>> with open(img, "wb") as fh:
+...     pickle.dump([3, 2, "#000000", {(1, 1): red}], fh)
+>>> newimage.load()
+>>> newimage.width, newimage[1, 1], newimage[0, 0], newimage.dense
+(3, '#FF0000', '#000000', True)
+>>> part.load_rows(0, 1) # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+LoadError: only binary image files can be loaded a band of rows at a time
+>>> auto = Image(64, 64)
+>>> for x in range(64):
+...     auto[x, 0] = red
+>>> auto.dense, auto[63, 0], auto[63, 1]
+(False, '#FF0000', '#FFFFFF')
+>>> auto[0, 1] = blue
+>>> auto.dense, auto[63, 0], auto[0, 1], auto[63, 1]
+(True, '#FF0000', '#0000FF', '#FFFFFF')
+>>> auto.resize(32, 2)
+True
+>>> auto[31, 0], auto[0, 1], auto.width, auto.height
+('#FF0000', '#0000FF', 32, 2)
+>>> sparse = Image(4, 4, dense=False)
+>>> sparse.set_many([(3, 3), (3, 0)], red)
+>>> sparse[0, 0] = blue
+>>> sorted(sparse.colors)
+['#0000FF', '#FF0000', '#FFFFFF']
+>>> sparse.resize(3, 3)
+True
+>>> sparse[0, 0] = red
+>>> sorted(sparse.colors)
+['#FF0000', '#FFFFFF']
+>>> del sparse[0, 0]
+>>> sorted(sparse.colors)
+['#FFFFFF']
+>>> cycled = Image(2, 2, dense=True)
+>>> for i in range(70000):
+...     cycled[0, 0] = "#{0:06X}".format(i)
+>>> cycled[0, 0], len(cycled.colors)
+('#01116F', 2)
 >>> image.thing
 Traceback (most recent call last):
 ...
@@ -53,10 +137,59 @@ AttributeError: 'Image' object has no attribute 'thing'
 """
 
 
+import array
+import collections
+import itertools
+import mmap
 import os
 import pickle
+import struct
+import sys
+import zlib
 
 USE_GETATTR = False
+# The characters an XPM file can use for a point's color, and the pairs
+# of them used when there are more colors than characters
+XPM_CHARS = [chr(x) for x in range(32, 127) if chr(x) != '"']
+XPM_PAIRS = [x + y for x in XPM_CHARS for y in XPM_CHARS]
+XPM_BUFFER_SIZE = 2 ** 20
+FILE_MAGIC = b"IMGB"
+FILE_VERSION = 2
+# magic, version, width, height, bytes per index, rows per band, colors
+FileHeader = struct.Struct("<4sHIIBII")
+LengthStruct = struct.Struct("<H")
+# Version 2 follows each color but the background with how many points
+# have it
+CountStruct = struct.Struct("<I")
+# Bands hold about this many points, so a few rows of a wide image
+BAND_POINTS = 65536
+# An image whose storage is chosen automatically becomes dense once
+# more than this fraction of its pixels are not the background
+DENSE_THRESHOLD = 1 / 64
+
+
+def _index_bytes(indexes, size):
+    """Returns the array('H') of indexes as size-byte little-endian
+    values"""
+    if sys.byteorder != "little":
+        indexes = array.array("H", indexes)
+        indexes.byteswap()
+    data = indexes.tobytes()
+    return data[::2] if size == 1 else data
+
+
+def _indexes_from_bytes(data, size):
+    """Returns an array('H') of the size-byte little-endian values in
+    data"""
+    if size == 1:
+        wide = bytearray(2 * len(data))
+        wide[::2] = data
+        data = wide
+    indexes = array.array("H")
+    indexes.frombytes(data)
+    if sys.byteorder != "little":
+        indexes.byteswap()
+    return indexes
 
 
 class ImageError(Exception): pass
@@ -70,17 +203,32 @@ class NoFilenameError(ImageError): pass
 class Image:
 
     def __init__(self, width, height, filename="",
-                 background="#FFFFFF"):
+                 background="#FFFFFF", dense=None):
         """An image represented as HTML-style color values
         (color names or hex strings) at (x, y) coordinates with any
         unspecified points assumed to be the background
+
+        A sparse image keeps a dict for each row that has points that
+        are not the background, mapping their x coordinates to their
+        colors; a dense one keeps an array of 16-bit indexes into a
+        table of its colors for every point. If dense is None the image
+        starts sparse and becomes dense once more than DENSE_THRESHOLD
+        of its points are set. Either way the number of points of each
+        color is counted as they are set, so colors is always exact.
         """
         self.filename = filename
         self.__background = background
-        self.__data = {}
+        self.__rows = {}
+        self.__points = 0
+        self.__counts = collections.Counter()
+        self.__pixels = None
+        self.__palette = [background]
+        self.__index_for_color = {background: 0}
+        self.__dense = dense
         self.__width = width
         self.__height = height
-        self.__colors = {self.__background}
+        if dense:
+            self.__make_dense()
 
 
     if USE_GETATTR:
@@ -97,7 +245,7 @@ class Image:
             AttributeError: 'Image' object has no attribute 'thing'
             """
             if name == "colors":
-                return set(self.__colors)
+                return set(self.__counts) | {self.__background}
             classname = self.__class__.__name__
             if name in frozenset({"background", "width", "height"}):
                 return self.__dict__["_{0}__{1}".format(classname, name)]
@@ -121,7 +269,93 @@ class Image:
 
         @property
         def colors(self):
-            return set(self.__colors)
+            return set(self.__counts) | {self.__background}
+
+
+    @property
+    def dense(self):
+        "Whether every point is stored rather than just the set ones"
+        return self.__pixels is not None
+
+
+    def __make_dense(self):
+        if len(self.__counts) >= 65536:
+            if self.__dense:
+                raise ImageError("too many colors for a dense image")
+            self.__dense = False # Stay sparse from now on
+            return
+        self.__palette = [self.__background] + sorted(self.__counts)
+        self.__index_for_color = {color: index for index, color
+                                  in enumerate(self.__palette)}
+        width = self.__width
+        pixels = array.array("H", [0]) * (width * self.__height)
+        for y, row in self.__rows.items():
+            for x, color in row.items():
+                pixels[y * width + x] = self.__index_for_color[color]
+        self.__pixels = pixels
+        self.__rows = None
+
+
+    def __add_color(self, color):
+        # Returns the new palette index of color, or None if there was
+        # no room for it and the automatic image became sparse instead
+        if len(self.__palette) == 65536:
+            self.__compact_palette()
+            if len(self.__palette) == 65536:
+                if self.__dense:
+                    raise ImageError("too many colors for a dense image")
+                self.__dense = False # Stay sparse from now on
+                self.__make_sparse()
+                return None
+        index = self.__index_for_color[color] = len(self.__palette)
+        self.__palette.append(color)
+        return index
+
+
+    def __compact_palette(self):
+        # Drops the colors that no point has any more and renumbers the
+        # points' indexes to match
+        palette = [self.__background] + [color for color in
+                self.__palette[1:] if color in self.__counts]
+        if len(palette) == len(self.__palette):
+            return
+        index_for_color = {color: index for index, color
+                           in enumerate(palette)}
+        translate = [index_for_color.get(color, 0)
+                     for color in self.__palette]
+        self.__pixels = array.array("H", [translate[index]
+                                          for index in self.__pixels])
+        self.__palette = palette
+        self.__index_for_color = index_for_color
+
+
+    def __uncount(self, color, count=1):
+        left = self.__counts[color] - count
+        if left:
+            self.__counts[color] = left
+        else:
+            del self.__counts[color]
+
+
+    def __index_counts(self, indexes):
+        # Returns (index, count) pairs for the palette indexes in the
+        # array; bytes.count() is much faster than a Counter while the
+        # palette is small
+        if len(self.__palette) <= 16:
+            data = _index_bytes(indexes, 1)
+            return [(index, count) for index, count in
+                    ((index, data.count(index))
+                     for index in range(len(self.__palette))) if count]
+        return collections.Counter(indexes).items()
+
+
+    def __count_indexes(self, indexes, sign=1):
+        for index, count in self.__index_counts(indexes):
+            if index:
+                if sign > 0:
+                    self.__counts[self.__palette[index]] += count
+                else:
+                    self.__uncount(self.__palette[index], count)
 
 
     def resize(self, width=None, height=None):
@@ -147,16 +381,70 @@ class Image:
         False
         """
         if width not in {None, self.__width} or height not in {None, self.__height}:
+            old_width, old_height = self.__width, self.__height
             self.__width = width or self.__width
             self.__height = height or self.__height
-            for coordinate in dict(self.__data).keys():
-                if coordinate[0] >= self.__width or coordinate[1] >= self.__height:
-                    self.__data.pop(tuple(coordinate), None)
-            self.__colors = set(self.__data.values()) | {self.__background}
+            if self.__pixels is not None:
+                self.__resize_dense(old_width, old_height)
+            else:
+                self.__resize_sparse(old_width, old_height)
             return True
         return False
 
 
+    def __resize_sparse(self, old_width, old_height):
+        # Only the rows, or the points in the rows, that are cut off are
+        # visited, whichever there are fewer of
+        rows = self.__rows
+        width, height = self.__width, self.__height
+        removed = []
+        if height < old_height:
+            for y in (range(height, old_height)
+                      if old_height - height < len(rows) else
+                      [y for y in rows if y >= height]):
+                row = rows.pop(y, None)
+                if row is not None:
+                    removed.extend(row.values())
+        if width < old_width:
+            for y, row in list(rows.items()):
+                for x in (range(width, old_width)
+                          if old_width - width < len(row) else
+                          [x for x in row if x >= width]):
+                    color = row.pop(x, None)
+                    if color is not None:
+                        removed.append(color)
+                if not row:
+                    del rows[y]
+        for color, count in collections.Counter(removed).items():
+            self.__uncount(color, count)
+        self.__points -= len(removed)
+
+
+    def __resize_dense(self, old_width, old_height):
+        # Only the points that are cut off are counted out
+        width, height = self.__width, self.__height
+        old = self.__pixels
+        if height < old_height:
+            self.__count_indexes(old[height * old_width:], -1)
+        if width < old_width:
+            for y in range(min(height, old_height)):
+                self.__count_indexes(old[y * old_width + width:
+                                         (y + 1) * old_width], -1)
+        if width == old_width:
+            if height < old_height:
+                del old[height * width:]
+            else:
+                old.extend(array.array("H", [0]) *
+                           ((height - old_height) * width))
+            return
+        columns = min(width, old_width)
+        pixels = array.array("H", [0]) * (width * height)
+        for y in range(min(height, old_height)):
+            pixels[y * width:y * width + columns] = old[
+                    y * old_width:y * old_width + columns]
+        self.__pixels = pixels
+
+
     def __getitem__(self, coordinate):
         """Returns the color at the given (x, y) coordinate; this will
         be the background color if the color has never been set
@@ -165,7 +453,13 @@ class Image:
         if (not (0 <= coordinate[0] < self.width) or
             not (0 <= coordinate[1] < self.height)):
             raise CoordinateError(str(coordinate))
-        return self.__data.get(tuple(coordinate), self.__background)
+        if self.__pixels is not None:
+            return self.__palette[self.__pixels[coordinate[1] *
+                                                self.__width + coordinate[0]]]
+        row = self.__rows.get(coordinate[1])
+        if row is None:
+            return self.__background
+        return row.get(coordinate[0], self.__background)
 
 
     def __setitem__(self, coordinate, color):
@@ -175,11 +469,43 @@ class Image:
         if (not (0 <= coordinate[0] < self.width) or
             not (0 <= coordinate[1] < self.height)):
             raise CoordinateError(str(coordinate))
+        x, y = coordinate
+        index = None
+        if self.__pixels is not None:
+            index = self.__index_for_color.get(color)
+            if index is None:
+                index = self.__add_color(color)
+        if index is not None:
+            offset = y * self.__width + x
+            old = self.__pixels[offset]
+            if old != index:
+                self.__pixels[offset] = index
+                if old:
+                    self.__uncount(self.__palette[old])
+                if index:
+                    self.__counts[color] += 1
+            return
+        row = self.__rows.get(y)
+        old = None if row is None else row.get(x)
         if color == self.__background:
-            self.__data.pop(tuple(coordinate), None)
-        else:
-            self.__data[tuple(coordinate)] = color
-            self.__colors.add(color)
+            if old is not None:
+                del row[x]
+                if not row:
+                    del self.__rows[y]
+                self.__points -= 1
+                self.__uncount(old)
+        elif old != color:
+            if row is None:
+                row = self.__rows[y] = {}
+            row[x] = color
+            self.__counts[color] += 1
+            if old is not None:
+                self.__uncount(old)
+            else:
+                self.__points += 1
+                if (self.__dense is None and self.__points >
+                    self.__width * self.__height * DENSE_THRESHOLD):
+                    self.__make_dense()
 
 
     def __delitem__(self, coordinate):
@@ -191,14 +517,212 @@ class Image:
         if (not (0 <= coordinate[0] < self.width) or
             not (0 <= coordinate[1] < self.height)):
             raise CoordinateError(str(coordinate))
-        self.__data.pop(tuple(coordinate), None)
+        self[coordinate] = self.__background
+
 
+    def fill_rect(self, x0, y0, x1, y1, color):
+        """Sets every point from (x0, y0) up to but not including
+        (x1, y1) to the given color
+        """
+        self.__check_rect(x0, y0, x1, y1)
+        if x0 >= x1 or y0 >= y1:
+            return
+        self.__grow((x1 - x0) * (y1 - y0))
+        index = self.__dense_index(color)
+        if index is not None:
+            width = self.__width
+            run = array.array("H", [index]) * (x1 - x0)
+            for y in range(y0, y1):
+                self.__count_indexes(self.__pixels[y * width + x0:
+                                                   y * width + x1], -1)
+                self.__pixels[y * width + x0:y * width + x1] = run
+            if index:
+                self.__counts[color] += (x1 - x0) * (y1 - y0)
+        else:
+            for y in range(y0, y1):
+                self.__set_row(y, range(x0, x1), color)
+
+
+    def set_many(self, coordinates, color):
+        """Sets the point at every (x, y) coordinate to the given color
+        """
+        coordinates = list(map(tuple, coordinates))
+        if not coordinates:
+            return
+        xs, ys = zip(*coordinates)
+        if (min(xs) < 0 or max(xs) >= self.__width or
+            min(ys) < 0 or max(ys) >= self.__height):
+            raise CoordinateError(str(next(
+                    coordinate for coordinate in coordinates
+                    if not (0 <= coordinate[0] < self.__width and
+                            0 <= coordinate[1] < self.__height))))
+        self.__grow(len(coordinates))
+        index = self.__dense_index(color)
+        if index is not None:
+            width = self.__width
+            self.__set_offsets({y * width + x for x, y in coordinates},
+                               index, color)
+        else:
+            xs_for_row = collections.defaultdict(set)
+            for x, y in coordinates:
+                xs_for_row[y].add(x)
+            for y, xs in xs_for_row.items():
+                self.__set_row(y, xs, color)
+
+
+    def fill_mask(self, mask, color, x=0, y=0):
+        """Sets the points to the given color where mask, a sequence of
+        rows of truth values (e.g., bools or bytes), is true with the
+        mask's top-left corner at (x, y)
+        """
+        rows = list(mask)
+        columns = max(map(len, rows), default=0)
+        self.__check_rect(x, y, x + columns, y + len(rows))
+        self.__grow(columns * len(rows))
+        index = self.__dense_index(color)
+        if index is not None:
+            width = self.__width
+            self.__set_offsets([offset for row, values in enumerate(rows, y)
+                                for offset in itertools.compress(
+                                    range(row * width + x,
+                                          row * width + x + len(values)),
+                                    values)], index, color)
+        else:
+            for row, values in enumerate(rows, y):
+                self.__set_row(row, list(itertools.compress(
+                               range(x, x + len(values)), values)), color)
+
+
+    def blit(self, other, x=0, y=0):
+        """Copies every point of the other image, including those of
+        its background color, with its top-left corner at (x, y)
+        """
+        if self.__pixels is not None and other.__pixels is not None:
+            self.__check_rect(x, y, x + other.width, y + other.height)
+            translate = [self.__dense_index(color)
+                         for color in other.__palette]
+        if self.__pixels is not None and other.__pixels is not None:
+            width = self.__width
+            other_width = other.width
+            same = translate == list(range(len(translate)))
+            for row in range(other.height):
+                source = other.__pixels[row * other_width:
+                                        (row + 1) * other_width]
+                if not same:
+                    source = array.array("H", [translate[index]
+                                               for index in source])
+                start = (y + row) * width + x
+                self.__count_indexes(
+                        self.__pixels[start:start + other_width], -1)
+                self.__pixels[start:start + other_width] = source
+                self.__count_indexes(source)
+            return
+        self.fill_rect(x, y, x + other.width, y + other.height,
+                       other.background)
+        for other_y, row in other.__row_points():
+            xs_for_color = collections.defaultdict(list)
+            for other_x, color in row.items():
+                xs_for_color[color].append(x + other_x)
+            for color, xs in xs_for_color.items():
+                index = self.__dense_index(color)
+                if index is not None:
+                    start = (y + other_y) * self.__width
+                    self.__set_offsets([start + x for x in xs], index,
+                                       color)
+                else:
+                    self.__set_row(y + other_y, xs, color)
+
+
+    def __check_rect(self, x0, y0, x1, y1):
+        if x0 < x1 and y0 < y1 and (x0 < 0 or y0 < 0 or
+                                    x1 > self.__width or
+                                    y1 > self.__height):
+            raise CoordinateError(str((x0, y0, x1, y1)))
+
+
+    def __grow(self, count):
+        # Bulk writes switch an automatic image to dense before rather
+        # than after adding up to count points to its dicts
+        if (self.__pixels is None and self.__dense is None and
+            self.__points + count >
+            self.__width * self.__height * DENSE_THRESHOLD):
+            self.__make_dense()
+
+
+    def __dense_index(self, color):
+        # Returns the palette index of color, or None if the image is
+        # sparse or had to become sparse to make room for color
+        if self.__pixels is None:
+            return None
+        index = self.__index_for_color.get(color)
+        if index is None:
+            index = self.__add_color(color)
+        return index
+
+
+    def __set_offsets(self, offsets, index, color):
+        # Sets the points at the offsets, which must not repeat, of a
+        # dense image to color, whose palette index is index
+        pixels = self.__pixels
+        self.__count_indexes(array.array("H", map(pixels.__getitem__,
+                                                  offsets)), -1)
+        for offset in offsets:
+            pixels[offset] = index
+        if index and offsets:
+            self.__counts[color] += len(offsets)
+
+
+    def __set_row(self, y, xs, color):
+        # Sets the points at the x coordinates in xs, which must not
+        # repeat, in row y of a sparse image
+        if not xs:
+            return
+        row = self.__rows.get(y)
+        if row is None:
+            if color == self.__background:
+                return
+            row = self.__rows[y] = {}
+        replaced = collections.Counter(map(row.get, xs))
+        added = replaced.pop(None, 0)
+        for old, count in replaced.items():
+            self.__uncount(old, count)
+        if color == self.__background:
+            for x in xs:
+                row.pop(x, None)
+            self.__points -= sum(replaced.values())
+            if not row:
+                del self.__rows[y]
+        else:
+            row.update(zip(xs, itertools.repeat(color)))
+            self.__counts[color] += added + sum(replaced.values())
+            self.__points += added
+
+
+    def __row_points(self):
+        # Yields (y, {x: color}) for each row with points that are not
+        # the background
+        if self.__pixels is None:
+            yield from self.__rows.items()
+            return
+        width = self.__width
+        palette = self.__palette
+        for y in range(self.__height):
+            row = self.__pixels[y * width:(y + 1) * width]
+            if row.count(0) != width:
+                yield y, {x: palette[row[x]]
+                          for x in itertools.compress(range(width), row)}
 
 
     def save(self, filename=None):
         """Saves the current image, or the one specified by filename
 
         If filename is specified the internal filename is set to it.
+        The file holds a FileHeader, the palette (the background first)
+        as length-prefixed UTF-8 strings each but the first followed by
+        its number of points, the compressed size of each band of rows
+        and then the bands, each the zlib-compressed
+        palette indexes of its points, one byte each if the palette has
+        no more than 256 colors, otherwise two (little-endian).
         """
         if filename is not None:
             self.filename = filename
@@ -207,21 +731,72 @@ class Image:
 
         fh = None
         try:
-            data = [self.width, self.height, self.__background,
-                    self.__data]
+            palette, index_size, band_rows, bands = self.__encode_bands()
             fh = open(self.filename, "wb")
-            pickle.dump(data, fh, pickle.HIGHEST_PROTOCOL)
-        except (EnvironmentError, pickle.PicklingError) as err:
+            fh.write(FileHeader.pack(FILE_MAGIC, FILE_VERSION, self.width,
+                                     self.height, index_size, band_rows,
+                                     len(palette)))
+            for color in palette:
+                data = color.encode("utf8")
+                fh.write(LengthStruct.pack(len(data)))
+                fh.write(data)
+                if color != self.__background:
+                    fh.write(CountStruct.pack(self.__counts[color]))
+            fh.write(struct.pack("<{0}I".format(len(bands)),
+                                 *[len(band) for band in bands]))
+            for band in bands:
+                fh.write(band)
+        except (EnvironmentError, UnicodeEncodeError, struct.error) as err:
             raise SaveError(str(err))
         finally:
             if fh is not None:
                 fh.close()
 
 
+    def __encode_bands(self):
+        # Returns the palette, the size of an index, the number of rows
+        # in a band and the compressed bands
+        width = self.__width
+        if self.__pixels is not None:
+            palette = [color for color in self.__palette
+                       if color in self.__counts or
+                          color == self.__background]
+            translate = None
+            if len(palette) != len(self.__palette):
+                index_for_color = {color: index for index, color
+                                   in enumerate(palette)}
+                translate = [index_for_color.get(color, 0)
+                             for color in self.__palette]
+        else:
+            palette = [self.__background] + sorted(self.__counts)
+            index_for_color = {color: index for index, color
+                               in enumerate(palette)}
+        index_size = 1 if len(palette) <= 256 else 2
+        band_rows = max(1, BAND_POINTS // max(1, width))
+        bands = []
+        for first in range(0, self.__height, band_rows):
+            last = min(first + band_rows, self.__height)
+            if self.__pixels is not None:
+                indexes = self.__pixels[first * width:last * width]
+                if translate is not None:
+                    indexes = array.array("H", [translate[index]
+                                                for index in indexes])
+            else:
+                indexes = array.array("H", [0]) * ((last - first) * width)
+                for y in range(first, last):
+                    for x, color in self.__rows.get(y, {}).items():
+                        indexes[(y - first) * width + x] = (
+                                index_for_color[color])
+            bands.append(zlib.compress(_index_bytes(indexes, index_size)))
+        return palette, index_size, band_rows, bands
+
+
     def load(self, filename=None):
         """Loads the current image, or the one specified by filename
 
         If filename is specified the internal filename is set to it.
+        Files saved in the pickle format used before the binary one
+        can still be loaded.
         """
         if filename is not None:
             self.filename = filename
@@ -231,11 +806,23 @@ class Image:
         fh = None
         try:
             fh = open(self.filename, "rb")
+            if fh.read(len(FILE_MAGIC)) == FILE_MAGIC:
+                self.__load_bands(fh, 0, None)
+                return
+            fh.seek(0)
             data = pickle.load(fh)
             (self.__width, self.__height, self.__background,
-             self.__data) = data
-            self.__colors = (set(self.__data.values()) |
-                             {self.__background})
+             points) = data
+            self.__rows = {}
+            for (x, y), color in points.items():
+                self.__rows.setdefault(y, {})[x] = color
+            self.__counts = collections.Counter(points.values())
+            self.__points = len(points)
+            self.__pixels = None
+            if self.__dense or (self.__dense is None and
+                    self.__points > self.__width * self.__height *
+                                    DENSE_THRESHOLD):
+                self.__make_dense()
         except (EnvironmentError, pickle.UnpicklingError) as err:
             raise LoadError(str(err))
         finally:
@@ -243,6 +830,102 @@ class Image:
                 fh.close()
 
 
+    def load_rows(self, start, stop, filename=None):
+        """Loads the rows from start up to but not including stop of
+        the current image, or the one specified by filename, so that
+        the image is stop - start rows high
+
+        Only the bands of rows that hold them are decompressed. If
+        filename is specified the internal filename is set to it.
+        """
+        if filename is not None:
+            self.filename = filename
+        if not self.filename:
+            raise NoFilenameError()
+
+        fh = None
+        try:
+            fh = open(self.filename, "rb")
+            if fh.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                raise LoadError("only binary image files can be loaded "
+                                "a band of rows at a time")
+            self.__load_bands(fh, start, stop)
+        except EnvironmentError as err:
+            raise LoadError(str(err))
+        finally:
+            if fh is not None:
+                fh.close()
+
+
+    def __load_bands(self, fh, start, stop):
+        # The file is memory-mapped so that only the bands that are
+        # needed are read
+        try:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                (magic, version, width, height, index_size, band_rows,
+                 count) = FileHeader.unpack_from(data)
+                if version > FILE_VERSION:
+                    raise LoadError("unsupported image file version "
+                                    "{0}".format(version))
+                if stop is None:
+                    stop = height
+                if not 0 <= start <= stop <= height:
+                    raise CoordinateError(str((start, stop)))
+                offset = FileHeader.size
+                palette = []
+                counts = collections.Counter()
+                for i in range(count):
+                    size, = LengthStruct.unpack_from(data, offset)
+                    offset += LengthStruct.size
+                    palette.append(data[offset:offset + size].decode("utf8"))
+                    offset += size
+                    if i and version > 1:
+                        counts[palette[-1]], = CountStruct.unpack_from(
+                                data, offset)
+                        offset += CountStruct.size
+                bands = -(-height // band_rows)
+                sizes = struct.unpack_from("<{0}I".format(bands), data,
+                                           offset)
+                offset += 4 * bands
+                pixels = array.array("H")
+                for first, size in zip(range(0, height, band_rows), sizes):
+                    if first < stop and first + band_rows > start:
+                        indexes = _indexes_from_bytes(zlib.decompress(
+                                data[offset:offset + size]), index_size)
+                        pixels.extend(indexes[
+                                max(0, start - first) * width:
+                                (min(stop, first + band_rows) - first) *
+                                width])
+                    offset += size
+        except (ValueError, struct.error, zlib.error) as err:
+            raise LoadError("invalid image file: {0}".format(err))
+        if not palette or len(pixels) != (stop - start) * width:
+            raise LoadError("invalid image file: missing colors or rows")
+        self.__width = width
+        self.__height = stop - start
+        self.__background = palette[0]
+        self.__palette = palette
+        self.__index_for_color = {color: index for index, color
+                                  in enumerate(palette)}
+        self.__pixels = pixels
+        self.__rows = None
+        if version > 1 and len(pixels) == width * height:
+            self.__counts = +counts # Drops colors with no points
+        else:
+            self.__counts = collections.Counter()
+            self.__count_indexes(pixels)
+        if self.__dense is False or (self.__dense is None and
+                len(pixels) - pixels.count(0) <=
+                len(pixels) * DENSE_THRESHOLD):
+            self.__make_sparse()
+
+
+    def __make_sparse(self):
+        self.__rows = dict(self.__row_points())
+        self.__points = sum(self.__counts.values())
+        self.__pixels = None
+
+
     def export(self, filename):
         """Exports the image to the specified filename
         """
@@ -254,45 +937,43 @@ class Image:
 
 
     def __export_xpm(self, filename):
-        """Exports the image as an XPM file if less than 8930 colors are
+        """Exports the image as an XPM file if less than 8650 colors are
         used
         """
         name = os.path.splitext(os.path.basename(filename))[0]
-        count = len(self.__colors)
-        chars = [chr(x) for x in range(32, 127) if chr(x) != '"']
-        if count > len(chars):
-            chars = []
-            for x in range(32, 127):
-                if chr(x) == '"':
-                    continue
-                for y in range(32, 127):
-                    if chr(y) == '"':
-                        continue
-                    chars.append(chr(x) + chr(y))
-        chars.reverse()
-        if count > len(chars):
+        if self.__pixels is not None:
+            colors = [color for color in self.__palette
+                      if color in self.__counts or
+                         color == self.__background]
+        else:
+            colors = [self.__background] + list(self.__counts)
+        chars = XPM_CHARS if len(colors) <= len(XPM_CHARS) else XPM_PAIRS
+        if len(colors) > len(chars):
             raise ExportError("cannot export XPM: too many colors")
+        code_for_color = {color: char.encode("ascii")
+                          for color, char in zip(colors, chars)}
         fh = None
         try:
-            fh = open(filename, "w", encoding="ascii")
-            fh.write("/* XPM */\n")
-            fh.write("static char *{0}[] = {{\n".format(name))
-            fh.write("/* columns rows colors chars-per-pixel */\n")
+            fh = open(filename, "wb", buffering=XPM_BUFFER_SIZE)
+            fh.write("/* XPM */\n".encode("ascii"))
+            fh.write("static char *{0}[] = {{\n".format(name).encode(
+                     "ascii"))
+            fh.write("/* columns rows colors chars-per-pixel */\n"
+                     .encode("ascii"))
             fh.write('"{0.width} {0.height} {1} {2}",\n'.format(
-                     self, count, len(chars[0])))
-            char_for_colour = {}
-            for color in self.__colors:
-                char = chars.pop()
-                fh.write('"{0} c {1}",\n'.format(char, color))
-                char_for_colour[color] = char
-            fh.write("/* pixels */\n")
-            for y in range(self.height):
-                row = []
-                for x in range(self.width):
-                    color = self.__data.get((x, y), self.__background)
-                    row.append(char_for_colour[color])
-                fh.write('"{0}",\n'.format("".join(row)))
-            fh.write("};\n")
+                     self, len(colors), len(chars[0])).encode("ascii"))
+            for color, char in zip(colors, chars):
+                fh.write('"{0} c {1}",\n'.format(char, color).encode(
+                         "ascii"))
+            fh.write("/* pixels */\n".encode("ascii"))
+            if self.__pixels is not None:
+                rows = self.__dense_xpm_rows(code_for_color,
+                                             len(chars[0]))
+            else:
+                rows = self.__sparse_xpm_rows(code_for_color, len(chars[0]))
+            for row in rows:
+                fh.write(b'"' + row + b'",\n')
+            fh.write("};\n".encode("ascii"))
         except EnvironmentError as err:
             raise ExportError(str(err))
         finally:
@@ -300,6 +981,47 @@ class Image:
                 fh.close()
 
 
+    def __dense_xpm_rows(self, code_for_color, size):
+        # Rows of palette indexes are turned into rows of codes by
+        # bytes.translate() when every index fits in a byte
+        blank = b" " * size
+        codes = [code_for_color.get(color, blank)
+                 for color in self.__palette]
+        width = self.__width
+        if len(codes) > 256:
+            for y in range(self.__height):
+                yield b"".join([codes[index] for index in
+                                self.__pixels[y * width:(y + 1) * width]])
+            return
+        tables = [bytes(code[i] for code in codes).ljust(256)
+                  for i in range(size)]
+        for y in range(self.__height):
+            indexes = _index_bytes(self.__pixels[y * width:(y + 1) * width],
+                                   1)
+            if size == 1:
+                yield indexes.translate(tables[0])
+            else:
+                row = bytearray(width * size)
+                for i, table in enumerate(tables):
+                    row[i::size] = indexes.translate(table)
+                yield row
+
+
+    def __sparse_xpm_rows(self, code_for_color, size):
+        # Each row starts as the background and has only its own
+        # points painted over it
+        blank = code_for_color[self.__background] * self.__width
+        for y in range(self.__height):
+            points = self.__rows.get(y)
+            if points is None:
+                yield blank
+                continue
+            row = bytearray(blank)
+            for x, color in points.items():
+                row[x * size:(x + 1) * size] = code_for_color[color]
+            yield row
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
\ No newline at end of file
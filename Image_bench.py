@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Compares the memory and speed of sparse and dense Images
+
+Paints a band of rows covering a percentage of a 4K (3840x2160) image
+one point at a time, then reads every point in the band back, with each
+storage mode, and reports the memory the image uses and how many points
+per second are set and read, and are set by filling the band with one
+fill_rect() call.
+"""
+
+import optparse
+import time
+import tracemalloc
+import Image_ans
+
+
+def main():
+    opts = parse_options()
+    rows = max(1, opts.height * opts.percent // 100)
+    colors = ["#{0:06X}".format(i * 0x10101) for i in range(16)]
+    print("{0:>8} {1:>10} {2:>14} {3:>12} {4:>12} {5:>12}".format("mode",
+          "MB", "bytes/point", "set/s", "get/s", "fill_rect/s"))
+    for mode, dense in (("sparse", False), ("dense", True), ("auto", None)):
+        tracemalloc.start()
+        image = paint(Image_ans.Image(opts.width, opts.height, dense=dense),
+                      rows, colors)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del image
+        image = Image_ans.Image(opts.width, opts.height, dense=dense)
+        start = time.perf_counter()
+        paint(image, rows, colors)
+        set_rate = opts.width * rows / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for y in range(rows):
+            for x in range(opts.width):
+                image[x, y]
+        get_rate = opts.width * rows / (time.perf_counter() - start)
+        del image
+        image = Image_ans.Image(opts.width, opts.height, dense=dense)
+        start = time.perf_counter()
+        image.fill_rect(0, 0, opts.width, rows, colors[1])
+        fill_rate = opts.width * rows / (time.perf_counter() - start)
+        del image
+        print("{0:>8} {1:>10.1f} {2:>14.1f} {3:>12.0f} {4:>12.0f} "
+              "{5:>12.0f}".format(mode, size / 2 ** 20,
+              size / (opts.width * opts.height), set_rate, get_rate,
+              fill_rate))
+
+
+def parse_options():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-W", "--width", dest="width", default=3840,
+            type="int", help="the image's width [default %default]")
+    parser.add_option("-H", "--height", dest="height", default=2160,
+            type="int", help="the image's height [default %default]")
+    parser.add_option("-p", "--percent", dest="percent", default=25,
+            type="int",
+            help="the percentage of the image's rows that are painted "
+                 "[default %default]")
+    opts, args = parser.parse_args()
+    return opts
+
+
+def paint(image, rows, colors):
+    for y in range(rows):
+        for x in range(image.width):
+            image[x, y] = colors[(x + y) % len(colors)]
+    return image
+
+
+if __name__ == "__main__":
+    main()
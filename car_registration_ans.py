@@ -9,33 +9,13 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
 # General Public License for more details.
 
-import collections
-import pickle
-import socket
-import struct
 import sys
 import Console
+from car_registration_client import CarTuple, Client, ClientError
 
 
 Address = ["localhost", 9653]
-CarTuple = collections.namedtuple("CarTuple", "seats mileage owner")
-
-
-class SocketManager:
-
-    def __init__(self, address):
-        self.address = address
-
-
-    def __enter__(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect(self.address)
-        return self.sock
-
-
-    def __exit__(self, *ignore):
-        self.sock.close()
-        
+Server = None
 
 
 def main():
@@ -73,6 +53,7 @@ def retrieve_car_details(previous_license):
             if choice is not None:
                 if not choice:
                     return previous_license, None
+                license = data[choice - 1]
                 ok, *data = handle_request("GET_CAR_DETAILS", license)
                 break
     return license, CarTuple(*data)
@@ -148,35 +129,17 @@ def stop_server(*ignore):
 
 
 def handle_request(*items, wait_for_reply=True):
-    version = 1
-    InfoStruct = struct.Struct("!IB")
-    data = pickle.dumps(items, 3)
-
+    global Server
+    if Server is None:
+        Server = Client(Address)
     try:
-        with SocketManager(tuple(Address)) as sock:
-            sock.sendall(InfoStruct.pack(len(data), version))
-            sock.sendall(data)
-            if not wait_for_reply:
-                return
-
-            info = sock.recv(InfoStruct.size)
-            size, server_version = InfoStruct.unpack(info)
-            assert server_version <= version, 'Incompatible server'
-            result = bytearray()
-            while True:
-                data = sock.recv(4000)
-                if not data:
-                    break
-                result.extend(data)
-                if len(result) >= size:
-                    break
-        return pickle.loads(result)
-    except socket.error as err:
-        print("{0}: is the server running?".format(err))
-        sys.exit(1)
-    except AssertionError as err:
+        if not wait_for_reply:
+            return Server.send(*items)
+        return Server.request(*items)
+    except ClientError as err:
         print(err)
         sys.exit(1)
 
 
-main()
+if __name__ == "__main__":
+    main()
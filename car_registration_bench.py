@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""Load generator for the car registration server
+
+Starts each requested server engine in a child process on a free port,
+fills it with fake registrations, and reports how many requests per
+second it answers as the number of concurrent client connections grows.
+The clients are AsyncClients on one event loop so that thousands of
+connections can be opened at once.
+"""
+
+import asyncio
+import multiprocessing
+import optparse
+import pickle
+import random
+import socket
+import time
+import timeit
+import tracemalloc
+import car_registration_client
+import car_registration_codec
+import car_registration_server_ans
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+
+def main():
+    opts = parse_options()
+    if opts.memory:
+        measure_memory(opts.memory)
+        return
+    if opts.codec:
+        measure_codec()
+        return
+    raise_file_limit()
+    licenses = list(make_cars(opts.cars))
+    if opts.bulk:
+        print("{0:>10} {1:>8} {2:>12} {3:>10}".format(
+              "engine", "load", "cars/s", "seconds"))
+    else:
+        print("{0:>10} {1:>8} {2:>12} {3:>10} {4:>7}".format(
+              "engine", "clients", "requests/s", "seconds", "errors"))
+    for engine in opts.engines:
+        address = ("localhost", free_port())
+        process = multiprocessing.Process(target=serve,
+                                          args=(engine, address, opts.cars))
+        process.start()
+        try:
+            wait_until_listening(address)
+            if opts.bulk:
+                bulk_load(engine, address, opts.bulk)
+                continue
+            for clients in opts.clients:
+                elapsed, errors = asyncio.run(run_clients(address,
+                        licenses, clients, opts.requests, opts.writes,
+                        opts.depth))
+                print("{0:>10} {1:>8} {2:>12.0f} {3:>10.2f} {4:>7}".format(
+                      engine, clients, opts.requests / elapsed, elapsed,
+                      errors))
+            if opts.stats:
+                print_stats(address)
+        finally:
+            process.terminate()
+            process.join()
+
+
+def parse_options():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-e", "--engines", dest="engines",
+            default="threading,asyncio",
+            help="comma-separated server engines to compare "
+                 "[default %default]")
+    parser.add_option("-c", "--cars", dest="cars", default=10000,
+            type="int",
+            help="the number of registrations to serve [default %default]")
+    parser.add_option("-r", "--requests", dest="requests", default=20000,
+            type="int",
+            help="the number of requests per run [default %default]")
+    parser.add_option("-n", "--clients", dest="clients",
+            default="1,4,16,64,256",
+            help=("comma-separated numbers of concurrent client "
+                  "connections [default %default]"))
+    parser.add_option("-w", "--writes", dest="writes", default=10,
+            type="int",
+            help="the percentage of CHANGE_MILEAGE requests "
+                 "[default %default]")
+    parser.add_option("-d", "--depth", dest="depth", default=1,
+            type="int",
+            help="the number of requests each client pipelines "
+                 "[default %default]")
+    parser.add_option("-b", "--bulk", dest="bulk", default=0,
+            type="int",
+            help=("instead of measuring throughput, register this many "
+                  "cars one request at a time and then as many again "
+                  "with MNEW_REGISTRATION batches"))
+    parser.add_option("-m", "--memory", dest="memory", default=0,
+            type="int",
+            help=("instead of measuring throughput, report the memory "
+                  "used by this many cars"))
+    parser.add_option("-s", "--stats", dest="stats", default=False,
+            action="store_true",
+            help="print each server's metrics after its runs")
+    parser.add_option("-k", "--codec", dest="codec", default=False,
+            action="store_true",
+            help=("instead of measuring throughput, compare the cost of "
+                  "encoding and decoding messages with pickle and with "
+                  "car_registration_codec"))
+    opts, args = parser.parse_args()
+    opts.engines = opts.engines.split(",")
+    opts.clients = [int(count) for count in opts.clients.split(",")]
+    return opts
+
+
+def raise_file_limit():
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def make_cars(count):
+    random.seed(count)
+    cars = {}
+    for i in range(count):
+        license = "{0:03d} {1:04d}".format(i // 10000, i % 10000)
+        cars[license] = car_registration_server_ans.Car(
+                random.choice((2, 4, 5, 6, 7)), random.randint(0, 100000),
+                "Owner {0}".format(i % 997))
+    return cars
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def serve(engine, address, count):
+    raise_file_limit()
+    car_registration_server_ans.RegistrationOperations.set_cars(
+            make_cars(count))
+    if engine == "asyncio":
+        server = car_registration_server_ans.AsyncCarRegistrationServer(
+                address)
+    else:
+        server = car_registration_server_ans.CarRegistrationServer(
+                address, car_registration_server_ans.RequestHandler)
+    server.serve_forever()
+
+
+def wait_until_listening(address):
+    for attempt in range(100):
+        try:
+            socket.create_connection(address).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+class DictCar:
+
+    def __init__(self, seats, mileage, owner):
+        # The layout Car had before it used __slots__ and interned owners
+        self.__seats = seats
+        self.__mileage = mileage
+        self.__owner = owner
+
+
+def measure_memory(count):
+    print("{0:>10} {1:>12} {2:>14}".format("car", "MB", "bytes per car"))
+    for Car in (DictCar, car_registration_server_ans.Car):
+        tracemalloc.start()
+        cars = {}
+        for i in range(count):
+            owner = "Owner {0}".format(i % 10007)
+            cars["{0:07d}".format(i)] = Car(4, i, owner)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del cars
+        print("{0:>10} {1:>12.1f} {2:>14.0f}".format(Car.__name__,
+              size / 2 ** 20, size / count))
+
+
+def measure_codec():
+    codec = car_registration_codec
+    licenses = ["{0:07d}".format(i) for i in range(1000)]
+    messages = (
+        ("GET_CAR_DETAILS", "request", ("GET_CAR_DETAILS", "FHV449")),
+        ("GET_CAR_DETAILS", "reply", (True, 5, 12288, "Simone Reneau")),
+        ("CHANGE_MILEAGE", "request", ("CHANGE_MILEAGE", "FHV449", 25000)),
+        ("NEW_REGISTRATION", "request",
+         ("NEW_REGISTRATION", "FHV449", 5, 12288, "Simone Reneau")),
+        ("MGET_CAR_DETAILS", "request", ("MGET_CAR_DETAILS", licenses)),
+        ("MGET_CAR_DETAILS", "reply",
+         (True, [(True, 5, 12288 + i, "Simone Reneau")
+                 for i in range(1000)])))
+    print("{0:>18} {1:>8} {2:>7} {3:>12} {4:>12} {5:>7} {6:>12} "
+          "{7:>12}".format("verb", "message", "pickle", "encode",
+                           "decode", "codec", "encode", "decode"))
+    for verb, kind, message in messages:
+        pickled = pickle.dumps((1, message), 3)
+        if kind == "request":
+            encode = lambda: codec.encode_request(1, message)
+            decode = codec.decode_request
+        else:
+            encode = lambda: codec.encode_reply(1, message, verb)
+            decode = codec.decode_reply
+        encoded = encode()
+        number = 200 if len(pickled) > 1000 else 20000
+        times = [min(timeit.repeat(function, number=number, repeat=3)) /
+                 number * 1e6 for function in (
+                    lambda: pickle.dumps((1, message), 3),
+                    lambda: pickle.loads(pickled),
+                    encode,
+                    lambda: decode(encoded))]
+        print("{0:>18} {1:>8} {2:>6}B {3:>10.2f}us {4:>10.2f}us {5:>6}B "
+              "{6:>10.2f}us {7:>10.2f}us".format(verb, kind, len(pickled),
+              times[0], times[1], len(encoded), times[2], times[3]))
+
+
+def print_stats(address):
+    with car_registration_client.Client(address) as client:
+        ok, stats = client.stats()
+    print(car_registration_server_ans.format_stats(stats))
+
+
+def bulk_load(engine, address, count):
+    with car_registration_client.Client(address, timeout=600) as client:
+        registrations = [("SINGLE {0:07d}".format(i), 4, i, "Fleet")
+                         for i in range(count)]
+        start = time.perf_counter()
+        for registration in registrations:
+            client.new_registration(*registration)
+        report(engine, "single", count, time.perf_counter() - start)
+        registrations = [("BATCH {0:07d}".format(i), 4, i, "Fleet")
+                         for i in range(count)]
+        start = time.perf_counter()
+        client.register_many(registrations)
+        report(engine, "batched", count, time.perf_counter() - start)
+        start = time.perf_counter()
+        client.get_car_details_many(license for license, *rest
+                                    in registrations)
+        report(engine, "mget", count, time.perf_counter() - start)
+
+
+def report(engine, how, count, elapsed):
+    print("{0:>10} {1:>8} {2:>12.0f} {3:>10.2f}".format(engine, how,
+          count / elapsed, elapsed))
+
+
+async def run_clients(address, licenses, clients, requests, writes, depth):
+    per_client = max(1, requests // clients)
+    connections = [car_registration_client.AsyncClient(address, timeout=60)
+                   for _ in range(clients)]
+    await asyncio.gather(*[connection.get_car_details(licenses[0])
+                           for connection in connections])
+    start = time.perf_counter()
+    results = await asyncio.gather(*[client(connection, licenses,
+                                            per_client, writes, depth)
+                                     for connection in connections],
+                                   return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    for connection in connections:
+        await connection.close()
+    return elapsed, sum(isinstance(result, Exception) for result in results)
+
+
+async def client(connection, licenses, count, writes, depth):
+    for start in range(0, count, depth):
+        requests = []
+        for i in range(min(depth, count - start)):
+            license = random.choice(licenses)
+            if random.randrange(100) < writes:
+                requests.append(connection.change_mileage(license,
+                                random.randint(0, 200000)))
+            else:
+                requests.append(connection.get_car_details(license))
+        await asyncio.gather(*requests)
+
+
+if __name__ == "__main__":
+    main()
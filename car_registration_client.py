@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+"""
+A client library for the car registration server.
+
+Client sends requests over a pool of persistent connections and can be
+shared between threads; AsyncClient pipelines requests from many
+coroutines over one connection. Both retry requests that fail because
+of a broken connection and raise ClientError rather than exiting, and
+every request method returns the server's reply tuple, (True, ...) or
+(False, message).
+"""
+
+import asyncio
+import collections
+import contextlib
+import pickle
+import select
+import socket
+import struct
+import threading
+import time
+import car_registration_codec
+
+
+InfoStruct = struct.Struct("!IB")
+CarTuple = collections.namedtuple("CarTuple", "seats mileage owner")
+# Requests that can safely be sent again if the connection breaks after
+# they were sent but before their reply arrived
+Idempotent = frozenset({"GET_CAR_DETAILS", "GET_LICENSES_STARTING_WITH",
+                        "MGET_CAR_DETAILS", "STATS"})
+
+
+class ClientError(Exception): pass
+
+
+class Connection:
+
+    def __init__(self, address, version=3, timeout=None):
+        """A connection to the car registration server
+
+        With version 2 the socket stays open between requests and
+        several requests may be sent before any replies are received;
+        each reply is matched to its request by id. With version 1 a
+        new socket is used for every request. Version 3 is version 2
+        with car_registration_codec in place of pickle. Socket errors,
+        including timeouts, are raised as ClientError.
+        """
+        self.address = address
+        self.version = version
+        self.timeout = timeout
+        self.sock = None
+        self.next_id = 0
+        self.replies = {}
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *ignore):
+        self.close()
+
+
+    def open(self):
+        if self.sock is None:
+            try:
+                self.sock = socket.create_connection(self.address,
+                                                     self.timeout)
+                self.sock.setsockopt(socket.IPPROTO_TCP,
+                                     socket.TCP_NODELAY, 1)
+            except socket.error as err:
+                raise ClientError(
+                        "{0}: is the server running?".format(err))
+
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.replies.clear()
+
+
+    def is_alive(self):
+        """Returns True unless the server has closed the connection
+
+        Only meaningful when no replies are outstanding: an idle
+        connection is readable only if it has been closed or reset.
+        """
+        if self.sock is None:
+            return False
+        readable, writable, broken = select.select([self.sock], [], [], 0)
+        return not readable
+
+
+    def send(self, *items):
+        """Sends a request without waiting for its reply and returns
+        the id needed to receive() it
+        """
+        self.open()
+        self.next_id += 1
+        frame = encode_request(self.version, self.next_id, items)
+        try:
+            self.sock.sendall(frame)
+        except socket.error as err:
+            self.close()
+            raise ClientError(str(err))
+        return self.next_id
+
+
+    def receive(self, request_id):
+        """Returns the reply to the request with the given id
+
+        Replies to other requests that arrive first are kept until
+        they are asked for.
+        """
+        try:
+            while request_id not in self.replies:
+                size, server_version = InfoStruct.unpack(
+                        receive_exactly(self.sock, InfoStruct.size))
+                if server_version != self.version:
+                    raise ClientError("Incompatible server")
+                reply_id, reply = decode_reply(self.version,
+                        receive_exactly(self.sock, size))
+                if reply_id == 0:
+                    raise ClientError(reply[1])
+                if self.version == 1:
+                    self.close()
+                    return reply
+                self.replies[reply_id] = reply
+        except (socket.error, ClientError,
+                car_registration_codec.CodecError) as err:
+            self.close()
+            raise ClientError(str(err))
+        return self.replies.pop(request_id)
+
+
+    def request(self, *items):
+        return self.receive(self.send(*items))
+
+
+    def pipeline(self, requests):
+        """Sends all the requests before reading any reply and returns
+        the replies in the same order as the requests
+
+        With version 1 each request is sent on a new socket once the
+        reply to the one before it has arrived.
+        """
+        if self.version == 1:
+            return [self.request(*items) for items in requests]
+        request_ids = [self.send(*items) for items in requests]
+        return [self.receive(request_id) for request_id in request_ids]
+
+
+def encode_request(version, request_id, items):
+    """Returns the complete frame that carries the request"""
+    if version >= 3:
+        try:
+            data = car_registration_codec.encode_request(request_id, items)
+        except car_registration_codec.CodecError as err:
+            raise ClientError(str(err))
+    elif version == 1:
+        data = pickle.dumps(items, 3)
+    else:
+        data = pickle.dumps((request_id, items), 3)
+    return InfoStruct.pack(len(data), version) + data
+
+
+def decode_reply(version, data):
+    """Returns the request id (None for version 1) and the reply"""
+    if version >= 3:
+        return car_registration_codec.decode_reply(data)
+    if version == 1:
+        return None, pickle.loads(data)
+    return pickle.loads(data)
+
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ClientError("connection closed by server")
+        data.extend(chunk)
+    return bytes(data)
+
+
+class ConnectionPool:
+
+    def __init__(self, address, size=4, timeout=5.0, version=3):
+        """Up to size persistent connections that threads borrow one at
+        a time with connection()
+        """
+        self.address = address
+        self.timeout = timeout
+        self.version = version
+        self.__idle = []
+        self.__lock = threading.Lock()
+        self.__available = threading.BoundedSemaphore(size)
+
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self.__available:
+            with self.__lock:
+                connection = self.__idle.pop() if self.__idle else None
+            if connection is None or not connection.is_alive():
+                if connection is not None:
+                    connection.close()
+                connection = Connection(self.address, self.version,
+                                        self.timeout)
+            try:
+                yield connection
+            except BaseException:
+                connection.close()
+                raise
+            with self.__lock:
+                self.__idle.append(connection)
+
+
+    def close(self):
+        with self.__lock:
+            for connection in self.__idle:
+                connection.close()
+            self.__idle.clear()
+
+
+class RequestMethods:
+    """One method per request verb; each returns request()'s result, so
+    they return replies for Client and awaitables for AsyncClient
+    """
+
+    def get_car_details(self, license):
+        return self.request("GET_CAR_DETAILS", license)
+
+
+    def change_mileage(self, license, mileage):
+        return self.request("CHANGE_MILEAGE", license, mileage)
+
+
+    def change_owner(self, license, owner):
+        return self.request("CHANGE_OWNER", license, owner)
+
+
+    def new_registration(self, license, seats, mileage, owner):
+        return self.request("NEW_REGISTRATION", license, seats, mileage,
+                            owner)
+
+
+    def get_licenses_starting_with(self, symbols, limit=None, offset=0):
+        return self.request("GET_LICENSES_STARTING_WITH", symbols, limit,
+                            offset)
+
+
+    def mget_car_details(self, licenses):
+        return self.request("MGET_CAR_DETAILS", list(licenses))
+
+
+    def mnew_registration(self, registrations):
+        return self.request("MNEW_REGISTRATION",
+                            [tuple(registration)
+                             for registration in registrations])
+
+
+    def stats(self):
+        """The reply holds the server's metrics as a dict"""
+        return self.request("STATS")
+
+
+class Client(RequestMethods):
+
+    def __init__(self, address, pool_size=4, timeout=5.0, retries=2,
+                 retry_delay=0.1, version=3):
+        """A thread-safe client that keeps up to pool_size connections
+        open to the server at address
+
+        A request that fails because its connection broke is tried
+        again up to retries times, waiting retry_delay seconds and
+        then twice as long each time; a request that is not idempotent
+        is only tried again if it cannot have reached the server.
+        Servers older than version 3 need version=2.
+        """
+        self.pool = ConnectionPool(tuple(address), pool_size, timeout,
+                                   version)
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *ignore):
+        self.close()
+
+
+    def close(self):
+        self.pool.close()
+
+
+    def request(self, *items):
+        return self.pipeline([items])[0]
+
+
+    def pipeline(self, requests):
+        """Sends all the requests on one connection without waiting for
+        replies and returns the replies in the same order
+
+        With version 1, whose server answers only one request per
+        connection, each request waits for the reply to the one before.
+        """
+        requests = list(requests)
+        idempotent = all(items[0] in Idempotent for items in requests)
+        for attempt in range(self.retries + 1):
+            sent = False
+            try:
+                with self.pool.connection() as connection:
+                    replies = []
+                    request_ids = []
+                    for items in requests:
+                        request_ids.append(connection.send(*items))
+                        sent = True
+                        if connection.version == 1:
+                            replies.append(connection.receive(
+                                    request_ids.pop()))
+                    return replies + [connection.receive(request_id)
+                                      for request_id in request_ids]
+            except ClientError:
+                if attempt == self.retries or (sent and not idempotent):
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+
+    def get_car_details_many(self, licenses, batch_size=10000):
+        """Returns a dict of the CarTuple for each of the licenses, or
+        None for those that are not registered
+        """
+        licenses = list(licenses)
+        details = {}
+        for start in range(0, len(licenses), batch_size):
+            batch = licenses[start:start + batch_size]
+            ok, replies = self.mget_car_details(batch)
+            for license, (ok, *data) in zip(batch, replies):
+                details[license] = CarTuple(*data) if ok else None
+        return details
+
+
+    def register_many(self, registrations, batch_size=10000):
+        """Registers each (license, seats, mileage, owner) item of
+        registrations and returns the replies in the same order
+        """
+        registrations = list(registrations)
+        replies = []
+        for start in range(0, len(registrations), batch_size):
+            ok, *data = self.mnew_registration(
+                    registrations[start:start + batch_size])
+            if not ok:
+                raise ClientError(data[0])
+            replies.extend(data[0])
+        return replies
+
+
+    def send(self, *items):
+        """Sends a request without waiting for a reply, for requests
+        such as SHUTDOWN that the server does not answer
+        """
+        with self.pool.connection() as connection:
+            connection.send(*items)
+            connection.close()
+
+
+    def shutdown(self):
+        self.send("SHUTDOWN")
+
+
+class AsyncClient(RequestMethods):
+
+    def __init__(self, address, timeout=5.0, retries=2, retry_delay=0.1,
+                 version=3):
+        """An asyncio client that pipelines the requests of any number
+        of coroutines over one connection to the server at address
+
+        Timeouts, retries and version behave as for Client, except
+        that version 1 is not supported.
+        """
+        assert version >= 2, "AsyncClient needs protocol version 2 or 3"
+        self.address = tuple(address)
+        self.version = version
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.__reader = self.__writer = None
+        self.__replies = {}
+        self.__next_id = 0
+        self.__connecting = None
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *ignore):
+        await self.close()
+
+
+    async def close(self):
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+
+
+    async def request(self, *items):
+        for attempt in range(self.retries + 1):
+            sent = False
+            try:
+                future = await self.__send(items)
+                sent = True
+                return await asyncio.wait_for(future, self.timeout)
+            except (ClientError, asyncio.TimeoutError) as err:
+                if attempt == self.retries or (sent and
+                                               items[0] not in Idempotent):
+                    if isinstance(err, ClientError):
+                        raise
+                    raise ClientError("timed out waiting for reply")
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+
+    async def get_car_details_many(self, licenses):
+        """Returns a dict of the CarTuple for each of the licenses, or
+        None for those that are not registered
+        """
+        licenses = list(licenses)
+        ok, replies = await self.mget_car_details(licenses)
+        return {license: CarTuple(*data) if ok else None
+                for license, (ok, *data) in zip(licenses, replies)}
+
+
+    async def shutdown(self):
+        """Asks the server to shut down; it sends no reply"""
+        await self.__send(("SHUTDOWN",))
+        await self.close()
+
+
+    async def __send(self, items):
+        await self.__connect()
+        self.__next_id += 1
+        data = encode_request(self.version, self.__next_id, items)
+        future = asyncio.get_running_loop().create_future()
+        self.__replies[self.__next_id] = future
+        self.__writer.write(data)
+        return future
+
+
+    async def __connect(self):
+        if self.__writer is not None:
+            return
+        if self.__connecting is None:
+            self.__connecting = asyncio.ensure_future(self.__open())
+        try:
+            await asyncio.shield(self.__connecting)
+        finally:
+            if self.__connecting.done():
+                self.__connecting = None
+
+
+    async def __open(self):
+        try:
+            reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(*self.address), self.timeout)
+        except (socket.error, asyncio.TimeoutError) as err:
+            raise ClientError("{0}: is the server running?".format(err))
+        self.__reader, self.__writer = reader, writer
+        asyncio.ensure_future(self.__receive_replies(reader, writer))
+
+
+    async def __receive_replies(self, reader, writer):
+        try:
+            while True:
+                size, server_version = InfoStruct.unpack(
+                        await reader.readexactly(InfoStruct.size))
+                if server_version != self.version:
+                    raise ClientError("Incompatible server")
+                reply_id, reply = decode_reply(self.version,
+                        await reader.readexactly(size))
+                if reply_id == 0:
+                    raise ClientError(reply[1])
+                future = self.__replies.pop(reply_id, None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (asyncio.IncompleteReadError, socket.error, ClientError,
+                car_registration_codec.CodecError) as err:
+            if self.__writer is writer:
+                self.__writer = None
+            writer.close()
+            replies, self.__replies = self.__replies, {}
+            for future in replies.values():
+                if not future.done():
+                    future.set_exception(ClientError(
+                            "connection lost: {0}".format(err)))
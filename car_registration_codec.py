@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+"""
+The binary codec used by version 3 of the car registration protocol.
+
+Unlike pickle, decoding never creates anything but None, bools, ints,
+floats, strings, tuples and dicts, so a server can accept requests from
+clients it does not trust.
+
+A request is the request id and a verb code followed by the verb's
+arguments, each encoded as its schema says: s a string, i an int, n an
+int or None, S a list of strings and R a list of (license, seats,
+mileage, owner) registrations. A reply is the request id and a reply
+schema code followed by the reply: F a failure's message, N nothing for
+(True, None), D car details, L the licenses of (True, *licenses), M a
+list of car details or failures, A a list of (True, None) or failures,
+or V any reply, encoded with a one-byte type tag before every value.
+Each verb's replies use its schema in ReplySchemas, and failures
+always use F; only STATS, and lists of strings that hold a NUL, need V.
+
+>>> data = encode_request(7, ("CHANGE_MILEAGE", "FHV449", 25000))
+>>> decode_request(data)
+(7, ('CHANGE_MILEAGE', 'FHV449', 25000))
+>>> decode_request(encode_request(8, ("GET_LICENSES_STARTING_WITH", "A")))
+(8, ('GET_LICENSES_STARTING_WITH', 'A', None, 0))
+>>> decode_request(encode_request(9, ("MNEW_REGISTRATION",
+...                                   [("A 1", 4, 10, "Ann")])))
+(9, ('MNEW_REGISTRATION', [('A 1', 4, 10, 'Ann')]))
+>>> decode_reply(encode_reply(7, (True, 5, 12288, "Simone Reneau"),
+...                            "GET_CAR_DETAILS"))
+(7, (True, 5, 12288, 'Simone Reneau'))
+>>> decode_reply(encode_reply(8, (False, "Not registered"),
+...                            "GET_CAR_DETAILS"))
+(8, (False, 'Not registered'))
+>>> decode_reply(encode_reply(9, (True, "A 1", "Ä 2"),
+...                            "GET_LICENSES_STARTING_WITH"))
+(9, (True, 'A 1', 'Ä 2'))
+>>> reply = (True, "A" + chr(0))
+>>> frame = encode_reply(9, reply, "GET_LICENSES_STARTING_WITH")
+>>> decode_reply(frame) == (9, reply)
+True
+>>> decode_reply(encode_reply(9, (True, [(True, 4, 10, "Ann"),
+...         (False, "Not registered")]), "MGET_CAR_DETAILS"))
+(9, (True, [(True, 4, 10, 'Ann'), (False, 'Not registered')]))
+>>> decode_reply(encode_reply(9, (True, [(True, None), (False, "No")]),
+...                            "MNEW_REGISTRATION"))
+(9, (True, [(True, None), (False, 'No')]))
+>>> decode_reply(encode_reply(9, (True, None), "CHANGE_OWNER"))
+(9, (True, None))
+>>> decode_reply(encode_reply(9, (True, [(True, None), (False, "No")])))
+(9, (True, ((True, None), (False, 'No'))))
+>>> decode_reply(encode_reply(10, (True, {"count": 2, "p50": 0.5}),
+...                            "STATS"))
+(10, (True, {'count': 2, 'p50': 0.5}))
+>>> encode_request(1, ("DELETE_EVERYTHING",)) # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+CodecError: cannot encode request DELETE_EVERYTHING
+>>> encode_request(2, ("CHANGE_MILEAGE", "FHV449")) # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+CodecError: cannot encode request CHANGE_MILEAGE: expected 2 arguments, got 1
+>>> decode_request(data[:-1]) # doctest: +IGNORE_EXCEPTION_DETAIL
+Traceback (most recent call last):
+...
+CodecError: malformed request
+"""
+
+import struct
+
+
+class CodecError(ValueError): pass
+
+
+RequestStruct = struct.Struct("!IB")
+ReplyStruct = struct.Struct("!IB")
+LengthStruct = struct.Struct("!H")
+CountStruct = struct.Struct("!I")
+IntStruct = struct.Struct("!q")
+FloatStruct = struct.Struct("!d")
+OptionalIntStruct = struct.Struct("!?q")
+RegistrationStruct = struct.Struct("!qq")
+DetailsStruct = struct.Struct("!Bq")
+DetailsItemStruct = struct.Struct("!?Bq")
+
+# verb: (code, argument schema, defaults for trailing arguments)
+Requests = dict(
+        GET_CAR_DETAILS=(1, "s", ()),
+        CHANGE_MILEAGE=(2, "si", ()),
+        CHANGE_OWNER=(3, "ss", ()),
+        NEW_REGISTRATION=(4, "siis", ()),
+        GET_LICENSES_STARTING_WITH=(5, "sni", (None, 0)),
+        MGET_CAR_DETAILS=(6, "S", ()),
+        MNEW_REGISTRATION=(7, "R", ()),
+        SHUTDOWN=(8, "", ()),
+        STATS=(9, "", ()))
+Verbs = {code: (verb, schema)
+         for verb, (code, schema, defaults) in Requests.items()}
+# verb: schema of its successful replies
+ReplySchemas = dict(
+        GET_CAR_DETAILS="D",
+        CHANGE_MILEAGE="N",
+        CHANGE_OWNER="N",
+        NEW_REGISTRATION="N",
+        GET_LICENSES_STARTING_WITH="L",
+        MGET_CAR_DETAILS="M",
+        MNEW_REGISTRATION="A",
+        STATS="V")
+
+
+def encode_request(request_id, items):
+    verb, *args = items
+    try:
+        code, schema, defaults = Requests[verb]
+    except KeyError:
+        raise CodecError("cannot encode request {0}".format(verb)) from None
+    missing = len(schema) - len(args)
+    if missing > 0:
+        args.extend(defaults[len(defaults) - missing:])
+    if len(args) != len(schema):
+        raise CodecError("cannot encode request {0}: expected {1} "
+                         "arguments, got {2}".format(verb, len(schema),
+                                                     len(items) - 1))
+    parts = [RequestStruct.pack(request_id, code)]
+    try:
+        for kind, value in zip(schema, args):
+            Encoders[kind](value, parts)
+    except (struct.error, TypeError, AttributeError) as err:
+        raise CodecError("cannot encode request {0}: {1}".format(verb,
+                                                                 err))
+    return b"".join(parts)
+
+
+def decode_request(data):
+    """Returns the request id and the request items"""
+    try:
+        request_id, code = RequestStruct.unpack_from(data)
+        verb, schema = Verbs[code]
+        items = [verb]
+        offset = RequestStruct.size
+        for kind in schema:
+            value, offset = Decoders[kind](data, offset)
+            items.append(value)
+    except (struct.error, KeyError, UnicodeDecodeError):
+        raise CodecError("malformed request") from None
+    if offset != len(data):
+        raise CodecError("malformed request")
+    return request_id, tuple(items)
+
+
+def encode_reply(request_id, reply, verb=None):
+    """Returns the encoded reply to a verb request; a reply whose verb
+    is not given is encoded with the V schema
+    """
+    schema = "F" if not reply[0] else ReplySchemas.get(verb, "V")
+    parts = [ReplyStruct.pack(request_id, ord(schema))]
+    try:
+        ReplyEncoders[schema](reply, parts)
+    except CodecError:
+        if schema == "V":
+            raise
+        # A list's strings held a NUL, which V can encode
+        parts = [ReplyStruct.pack(request_id, ord("V"))]
+        encode_value(reply, parts)
+    except (struct.error, TypeError, ValueError) as err:
+        raise CodecError("cannot encode reply to {0}: {1}".format(verb,
+                                                                  err))
+    return b"".join(parts)
+
+
+def decode_reply(data):
+    """Returns the request id and the reply"""
+    try:
+        request_id, schema = ReplyStruct.unpack_from(data)
+        reply, offset = ReplyDecoders[schema](data, ReplyStruct.size)
+    except (struct.error, KeyError, IndexError, TypeError,
+            UnicodeDecodeError):
+        raise CodecError("malformed reply") from None
+    if offset != len(data):
+        raise CodecError("malformed reply")
+    return request_id, reply
+
+
+def encode_string(value, parts):
+    data = value.encode("utf8")
+    parts.append(LengthStruct.pack(len(data)))
+    parts.append(data)
+
+
+def decode_string(data, offset):
+    size, = LengthStruct.unpack_from(data, offset)
+    offset += LengthStruct.size
+    if offset + size > len(data):
+        raise struct.error("string runs past the end of the data")
+    return str(data[offset:offset + size], "utf8"), offset + size
+
+
+def encode_int(value, parts):
+    parts.append(IntStruct.pack(value))
+
+
+def decode_int(data, offset):
+    return IntStruct.unpack_from(data, offset)[0], offset + IntStruct.size
+
+
+def encode_optional_int(value, parts):
+    parts.append(OptionalIntStruct.pack(value is not None, value or 0))
+
+
+def decode_optional_int(data, offset):
+    present, value = OptionalIntStruct.unpack_from(data, offset)
+    return value if present else None, offset + OptionalIntStruct.size
+
+
+def encode_text(values, parts):
+    # Encodes the strings values as one UTF-8 run separated by NULs,
+    # which split() takes apart far faster than slicing by lengths
+    text = "\x00".join(values)
+    if text.count("\x00") != max(len(values) - 1, 0):
+        raise CodecError("cannot encode a list of strings holding NUL")
+    data = text.encode("utf8")
+    parts.append(CountStruct.pack(len(data)))
+    parts.append(data)
+
+
+def decode_text(data, offset, count):
+    # Returns the count strings held in one run by encode_text()
+    size, = CountStruct.unpack_from(data, offset)
+    offset += CountStruct.size
+    end = offset + size
+    if end > len(data):
+        raise struct.error("text runs past the end of the data")
+    values = str(data[offset:end], "utf8").split("\x00") if count else []
+    if len(values) != count:
+        raise struct.error("text does not hold {0} strings".format(count))
+    return values, end
+
+
+def encode_strings(values, parts):
+    parts.append(CountStruct.pack(len(values)))
+    encode_text(values, parts)
+
+
+def decode_strings(data, offset):
+    count, = CountStruct.unpack_from(data, offset)
+    return decode_text(data, offset + CountStruct.size, count)
+
+
+def encode_registrations(values, parts):
+    parts.append(CountStruct.pack(len(values)))
+    for license, seats, mileage, owner in values:
+        encode_string(license, parts)
+        parts.append(RegistrationStruct.pack(seats, mileage))
+        encode_string(owner, parts)
+
+
+def decode_registrations(data, offset):
+    count, = CountStruct.unpack_from(data, offset)
+    offset += CountStruct.size
+    values = []
+    for i in range(count):
+        license, offset = decode_string(data, offset)
+        seats, mileage = RegistrationStruct.unpack_from(data, offset)
+        owner, offset = decode_string(data,
+                                      offset + RegistrationStruct.size)
+        values.append((license, seats, mileage, owner))
+    return values, offset
+
+
+Encoders = dict(s=encode_string, i=encode_int, n=encode_optional_int,
+                S=encode_strings, R=encode_registrations)
+Decoders = dict(s=decode_string, i=decode_int, n=decode_optional_int,
+                S=decode_strings, R=decode_registrations)
+
+
+def encode_value(value, parts):
+    try:
+        encode = ValueEncoders[type(value)]
+    except KeyError:
+        raise CodecError("cannot encode {0!r}".format(value)) from None
+    encode(value, parts)
+
+
+def encode_sequence(value, parts):
+    parts.append(b"t" + CountStruct.pack(len(value)))
+    for item in value:
+        encode_value(item, parts)
+
+
+def encode_mapping(value, parts):
+    parts.append(b"m" + CountStruct.pack(len(value)))
+    for key, item in value.items():
+        encode_value(key, parts)
+        encode_value(item, parts)
+
+
+def decode_value(data, offset):
+    return ValueDecoders[data[offset]](data, offset + 1)
+
+
+def decode_sequence(data, offset):
+    count, = CountStruct.unpack_from(data, offset)
+    offset += CountStruct.size
+    items = []
+    for i in range(count):
+        item, offset = ValueDecoders[data[offset]](data, offset + 1)
+        items.append(item)
+    return tuple(items), offset
+
+
+def decode_mapping(data, offset):
+    count, = CountStruct.unpack_from(data, offset)
+    offset += CountStruct.size
+    mapping = {}
+    for i in range(count):
+        key, offset = ValueDecoders[data[offset]](data, offset + 1)
+        mapping[key], offset = ValueDecoders[data[offset]](data, offset + 1)
+    return mapping, offset
+
+
+ValueEncoders = {
+        type(None): lambda value, parts: parts.append(b"N"),
+        bool: lambda value, parts: parts.append(b"T" if value else b"F"),
+        int: lambda value, parts: parts.append(b"i" +
+                                               IntStruct.pack(value)),
+        float: lambda value, parts: parts.append(b"d" +
+                                                 FloatStruct.pack(value)),
+        str: lambda value, parts: (parts.append(b"s"),
+                                   encode_string(value, parts)),
+        tuple: encode_sequence,
+        list: encode_sequence,
+        dict: encode_mapping}
+ValueDecoders = {
+        ord("N"): lambda data, offset: (None, offset),
+        ord("T"): lambda data, offset: (True, offset),
+        ord("F"): lambda data, offset: (False, offset),
+        ord("i"): decode_int,
+        ord("d"): lambda data, offset: (
+                FloatStruct.unpack_from(data, offset)[0],
+                offset + FloatStruct.size),
+        ord("s"): decode_string,
+        ord("t"): decode_sequence,
+        ord("m"): decode_mapping}
+
+
+
+def encode_details(reply, parts):
+    ok, seats, mileage, owner = reply
+    parts.append(DetailsStruct.pack(seats, mileage))
+    encode_string(owner, parts)
+
+
+def decode_details(data, offset):
+    seats, mileage = DetailsStruct.unpack_from(data, offset)
+    owner, offset = decode_string(data, offset + DetailsStruct.size)
+    return (True, seats, mileage, owner), offset
+
+
+def encode_details_list(reply, parts):
+    # Each item is a DetailsItemStruct, and their owners (or failure
+    # messages) follow as one run of text
+    ok, replies = reply
+    parts.append(CountStruct.pack(len(replies)))
+    texts = []
+    for item in replies:
+        if item[0]:
+            ok, seats, mileage, text = item
+        else:
+            ok, text = item
+            seats = mileage = 0
+        parts.append(DetailsItemStruct.pack(ok, seats, mileage))
+        texts.append(text)
+    encode_text(texts, parts)
+
+
+def decode_details_list(data, offset):
+    count, = CountStruct.unpack_from(data, offset)
+    offset += CountStruct.size
+    end = offset + count * DetailsItemStruct.size
+    items = DetailsItemStruct.iter_unpack(data[offset:end])
+    texts, offset = decode_text(data, end, count)
+    replies = [(True, seats, mileage, text) if ok else (False, text)
+               for (ok, seats, mileage), text in zip(items, texts)]
+    return (True, replies), offset
+
+
+def encode_outcomes(reply, parts):
+    # Like encode_details_list() for replies that are (True, None) or
+    # a failure
+    ok, replies = reply
+    parts.append(CountStruct.pack(len(replies)))
+    parts.append(bytes(bool(item[0]) for item in replies))
+    encode_text([item[1] or "" for item in replies], parts)
+
+
+def decode_outcomes(data, offset):
+    count, = CountStruct.unpack_from(data, offset)
+    offset += CountStruct.size
+    oks = data[offset:offset + count]
+    texts, offset = decode_text(data, offset + count, count)
+    replies = [(True, None) if ok else (False, text)
+               for ok, text in zip(oks, texts)]
+    return (True, replies), offset
+
+
+def decode_failure(data, offset):
+    message, offset = decode_string(data, offset)
+    return (False, message), offset
+
+
+def decode_licenses(data, offset):
+    licenses, offset = decode_strings(data, offset)
+    return (True, *licenses), offset
+
+
+ReplyEncoders = dict(
+        F=lambda reply, parts: encode_string(reply[1], parts),
+        N=lambda reply, parts: None,
+        D=encode_details,
+        L=lambda reply, parts: encode_strings(reply[1:], parts),
+        M=encode_details_list,
+        A=encode_outcomes,
+        V=encode_value)
+ReplyDecoders = {
+        ord("F"): decode_failure,
+        ord("N"): lambda data, offset: ((True, None), offset),
+        ord("D"): decode_details,
+        ord("L"): decode_licenses,
+        ord("M"): decode_details_list,
+        ord("A"): decode_outcomes,
+        ord("V"): decode_value}
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
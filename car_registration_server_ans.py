@@ -9,9 +9,12 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
 # General Public License for more details.
 
+import asyncio
+import bisect
 import contextlib
-import copy
 import gzip
+import math
+import optparse
 import os
 import pickle
 import random
@@ -19,16 +22,37 @@ import socketserver
 import struct
 import sys
 import threading
+import time
+import zlib
+import car_registration_codec
 
 
 class Car:
 
+    __slots__ = ("__seats", "__mileage", "__owner")
+
     def __init__(self, seats, mileage, owner):
+        """A car's registration details
+
+        Cars have no __dict__ and share one copy of each owner's name,
+        since there may be millions of them in memory.
+        """
         self.__seats = seats
         self.mileage = mileage
         self.owner = owner
 
 
+    def __getstate__(self):
+        return (self.__seats, self.__mileage, self.__owner)
+
+
+    def __setstate__(self, state):
+        if isinstance(state, dict): # Pickled before Car had __slots__
+            state = (state["_Car__seats"], state["_Car__mileage"],
+                     state["_Car__owner"])
+        self.__init__(*state)
+
+
     @property
     def seats(self):
         return self.__seats
@@ -51,17 +75,414 @@ class Car:
 
     @owner.setter
     def owner(self, owner):
-        self.__owner = owner
-
+        self.__owner = sys.intern(owner)
+
+
+
+class ReadWriteLock:
+
+    def __init__(self):
+        """A lock that any number of readers may hold at the same time
+        but that a writer holds on its own
+
+        Waiting writers are preferred so that a steady stream of
+        readers cannot starve them.
+        """
+        self.__condition = threading.Condition(threading.Lock())
+        self.__readers = 0
+        self.__writing = False
+        self.__writers_waiting = 0
+        self.read_waits = self.read_wait_time = 0
+        self.write_waits = self.write_wait_time = 0
+
+
+    def wait_times(self):
+        """Returns how many times each kind of lock has been taken and
+        how many seconds were spent in total waiting to take it
+        """
+        with self.__condition:
+            return dict(read_waits=self.read_waits,
+                        read_wait_time=self.read_wait_time,
+                        write_waits=self.write_waits,
+                        write_wait_time=self.write_wait_time)
+
+
+    @contextlib.contextmanager
+    def read_locked(self):
+        start = time.perf_counter()
+        with self.__condition:
+            while self.__writing or self.__writers_waiting:
+                self.__condition.wait()
+            self.__readers += 1
+            self.read_waits += 1
+            self.read_wait_time += time.perf_counter() - start
+        try:
+            yield
+        finally:
+            with self.__condition:
+                self.__readers -= 1
+                if not self.__readers:
+                    self.__condition.notify_all()
+
+
+    @contextlib.contextmanager
+    def write_locked(self):
+        start = time.perf_counter()
+        with self.__condition:
+            self.__writers_waiting += 1
+            while self.__writing or self.__readers:
+                self.__condition.wait()
+            self.__writers_waiting -= 1
+            self.__writing = True
+            self.write_waits += 1
+            self.write_wait_time += time.perf_counter() - start
+        try:
+            yield
+        finally:
+            with self.__condition:
+                self.__writing = False
+                self.__condition.notify_all()
+
+
+
+class Journal:
+
+    RecordStruct = struct.Struct("!II")
+
+    def __init__(self, filename, segment=1):
+        """An append-only log of the changes made to the registrations
+
+        Changes are written to numbered segment files, filename.1,
+        filename.2, etc., and a new segment is started whenever a
+        snapshot is taken so that older segments can be deleted.
+        log() only queues a change; a single committer thread writes
+        everything queued and fsyncs once per batch (group commit),
+        and wait() blocks until a given change is on disk. Writing
+        starts in a new segment, numbered at least segment, so a
+        segment left incomplete by a crash is never appended to.
+        """
+        self.filename = filename
+        self.segment = max(max(journal_segments(filename), default=0) + 1,
+                           segment)
+        self.changes = 0
+        self.__fh = open(journal_segment_name(filename, self.segment), "ab")
+        self.__condition = threading.Condition()
+        self.__pending = []
+        self.__logged = 0
+        self.__committed = 0
+        self.__closed = False
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__commit_changes)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+
+    def log(self, *change):
+        """Queues the change and returns the ticket to wait() on"""
+        data = pickle.dumps(change, 3)
+        with self.__condition:
+            self.__pending.append(self.RecordStruct.pack(len(data),
+                                  zlib.crc32(data)) + data)
+            self.__logged += 1
+            self.changes += 1
+            self.__condition.notify_all()
+            return self.__logged
+
+
+    def wait(self, ticket):
+        """Blocks until the change with the given ticket is on disk
+
+        Raises EnvironmentError if the journal could not be written.
+        """
+        with self.__condition:
+            while self.__committed < ticket and self.__error is None:
+                self.__condition.wait()
+            if self.__committed < ticket:
+                raise self.__error
+
+
+    def rotate(self):
+        """Commits every queued change, starts a new segment and
+        returns its number
+        """
+        with self.__condition:
+            while (self.__committed < self.__logged and
+                   self.__error is None):
+                self.__condition.wait()
+            self.__fh.close()
+            self.segment += 1
+            self.changes = 0
+            self.__fh = open(journal_segment_name(self.filename,
+                                                  self.segment), "ab")
+            return self.segment
+
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__thread.join()
+        self.__fh.close()
+        if not self.changes:
+            os.remove(self.__fh.name)
+
+
+    def __commit_changes(self):
+        while True:
+            with self.__condition:
+                while not self.__pending and not self.__closed:
+                    self.__condition.wait()
+                if not self.__pending:
+                    return
+                batch, self.__pending = self.__pending, []
+                ticket = self.__logged
+                fh = self.__fh
+            try:
+                fh.write(b"".join(batch))
+                fh.flush()
+                os.fsync(fh.fileno())
+            except EnvironmentError as err:
+                print("server failed to journal changes: {0}".format(err))
+                with self.__condition:
+                    self.__error = err
+                    self.__condition.notify_all()
+                return
+            with self.__condition:
+                self.__committed = ticket
+                self.__condition.notify_all()
+
+
+def journal_segments(filename):
+    directory, prefix = os.path.split(filename)
+    prefix += "."
+    segments = []
+    for name in os.listdir(directory or "."):
+        if name.startswith(prefix) and name[len(prefix):].isdigit():
+            segments.append(int(name[len(prefix):]))
+    return sorted(segments)
+
+
+def journal_segment_name(filename, segment):
+    return "{0}.{1}".format(filename, segment)
+
+
+def read_journal_segment(filename):
+    """Yields the changes in the segment up to the first incomplete or
+    corrupt record, which is where a crash interrupted the writing
+    """
+    RecordStruct = Journal.RecordStruct
+    with open(filename, "rb") as fh:
+        while True:
+            info = fh.read(RecordStruct.size)
+            if len(info) < RecordStruct.size:
+                return
+            size, crc = RecordStruct.unpack(info)
+            data = fh.read(size)
+            if len(data) < size or zlib.crc32(data) != crc:
+                return
+            yield pickle.loads(data)
+
+
+Replay = dict(
+        NEW_REGISTRATION=lambda cars, license, seats, mileage, owner: (
+                cars.__setitem__(license, Car(seats, mileage, owner))),
+        CHANGE_MILEAGE=lambda cars, license, mileage: (
+                setattr(cars[license], "mileage", mileage)),
+        CHANGE_OWNER=lambda cars, license, owner: (
+                setattr(cars[license], "owner", owner)),
+        MNEW_REGISTRATION=lambda cars, registrations: (
+                cars.update((license, Car(seats, mileage, owner))
+                            for license, seats, mileage, owner
+                            in registrations)))
+
+
+def replay(filename, segment, cars):
+    """Applies the changes journalled in the given segment and every
+    later one to cars and returns how many there were
+
+    Every change sets a value rather than adjusting one, so replaying
+    a change that a snapshot already includes does no harm.
+    """
+    count = 0
+    for number in journal_segments(filename):
+        if number >= segment:
+            for verb, *args in read_journal_segment(
+                    journal_segment_name(filename, number)):
+                Replay[verb](cars, *args)
+                count += 1
+    return count
+
+
+def snapshot(filename, journal):
+    """Saves the registrations and deletes the journal segments that
+    the saved copy makes redundant
+
+    Only starting the new segment and listing the cars is done with
+    the registrations locked; copying and saving are not, since any
+    change that races with them is also in the new segment.
+    """
+    segment = journal.rotate()
+    with RegistrationOperations.CarsLock.read_locked():
+        items = list(RegistrationOperations.Cars.items())
+    cars = {license: Car(car.seats, car.mileage, car.owner)
+            for license, car in items}
+    if save(filename, cars, segment):
+        for number in journal_segments(journal.filename):
+            if number < segment:
+                os.remove(journal_segment_name(journal.filename, number))
+    return len(cars)
+
+
+class Snapshotter(threading.Thread):
+
+    def __init__(self, filename, journal, interval=60, threshold=10000):
+        """Takes a snapshot every interval seconds once at least
+        threshold changes have been journalled since the last one
+        """
+        super().__init__()
+        self.daemon = True
+        self.filename = filename
+        self.journal = journal
+        self.interval = interval
+        self.threshold = threshold
+        self.stopped = threading.Event()
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.journal.changes >= self.threshold:
+                snapshot(self.filename, self.journal)
+
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+
+class Metrics:
+
+    # Latency bucket i holds times up to 2 ** ((i + 1) / BucketsPerOctave)
+    # microseconds, so a percentile is reported to within about 19%.
+    BucketsPerOctave = 4
+    Buckets = 128
+
+    def __init__(self):
+        """Counts the requests served, the bytes read and written, and
+        the latency of each verb as a histogram of logarithmic buckets
+
+        record() may be called from any thread.
+        """
+        self.__lock = threading.Lock()
+        self.started = time.time()
+        self.connections = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.verbs = {}
+
+
+    def connected(self):
+        with self.__lock:
+            self.connections += 1
+
+
+    def record(self, verb, seconds, bytes_in, bytes_out, ok=True):
+        bucket = 0
+        if seconds > 1e-6:
+            bucket = min(int(math.log2(seconds * 1e6) *
+                             self.BucketsPerOctave), self.Buckets - 1)
+        with self.__lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            stats = self.verbs.get(verb)
+            if stats is None:
+                stats = self.verbs[verb] = [0, 0, 0.0, 0.0,
+                                            [0] * self.Buckets]
+            stats[0] += 1
+            if not ok:
+                stats[1] += 1
+            stats[2] += seconds
+            stats[3] = max(stats[3], seconds)
+            stats[4][bucket] += 1
+
+
+    def percentile(self, histogram, fraction):
+        """Returns the upper bound in seconds of the bucket that holds
+        the given fraction of the times recorded in histogram
+        """
+        wanted = fraction * sum(histogram)
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if count and seen >= wanted:
+                break
+        return 2 ** ((bucket + 1) / self.BucketsPerOctave) / 1e6
+
+
+    def stats(self, lock=None):
+        """Returns a dict of the metrics, including lock's wait times
+        if it is given, that holds only strings and numbers
+        """
+        with self.__lock:
+            verbs = {}
+            for verb, (count, errors, total, longest,
+                       histogram) in self.verbs.items():
+                verbs[verb] = dict(count=count, errors=errors,
+                                   mean=total / count, max=longest,
+                                   p50=min(self.percentile(histogram,
+                                                           0.5), longest),
+                                   p99=min(self.percentile(histogram,
+                                                           0.99), longest))
+            stats = dict(uptime=time.time() - self.started,
+                         connections=self.connections,
+                         bytes_in=self.bytes_in, bytes_out=self.bytes_out,
+                         verbs=verbs)
+        if lock is not None:
+            stats["cars_lock"] = lock.wait_times()
+        return stats
+
+
+def format_stats(stats):
+    """Returns stats, as returned by Metrics.stats(), as a table"""
+    lines = ["uptime {0:.0f}s, {1} connections, {2} bytes in, {3} bytes "
+             "out".format(stats["uptime"], stats["connections"],
+                          stats["bytes_in"], stats["bytes_out"])]
+    lines.append("{0:>26} {1:>9} {2:>7} {3:>10} {4:>10} {5:>10} "
+                 "{6:>10}".format("verb", "count", "errors", "mean ms",
+                                  "p50 ms", "p99 ms", "max ms"))
+    for verb, verb_stats in sorted(stats["verbs"].items()):
+        lines.append("{0:>26} {count:>9} {errors:>7} {1:>10.3f} "
+                     "{2:>10.3f} {3:>10.3f} {4:>10.3f}".format(verb,
+                     verb_stats["mean"] * 1000, verb_stats["p50"] * 1000,
+                     verb_stats["p99"] * 1000, verb_stats["max"] * 1000,
+                     **verb_stats))
+    lock = stats.get("cars_lock")
+    if lock is not None:
+        lines.append("CarsLock: {read_waits} reads waited {0:.3f}s, "
+                     "{write_waits} writes waited {1:.3f}s".format(
+                     lock["read_wait_time"], lock["write_wait_time"],
+                     **lock))
+    return "\n".join(lines)
 
 
 class Finish(Exception): pass
 
 
-class RequestHandler(socketserver.StreamRequestHandler):
-
-    CarsLock = threading.Lock()
-    CallLock = threading.Lock()
+class RegistrationOperations:
+    """The registrations and the operations on them, shared by the
+    thread-per-connection RequestHandler and the AsyncRequestHandler
+    """
+
+    Version = 3
+    AllowPickle = True
+    SizeStruct = struct.Struct("!IB")
+    # CarsLock guards the set of licenses: registering a car needs the
+    # write lock, everything else shares the read lock and then takes
+    # the shard lock of the one car it reads or changes.
+    CarsLock = ReadWriteLock()
+    ShardLocks = tuple(threading.Lock() for _ in range(64))
+    Journal = None
+    Metrics = Metrics()
     Call = dict(
             GET_CAR_DETAILS=(
                     lambda self, *args: self.get_car_details(*args)),
@@ -73,62 +494,149 @@ class RequestHandler(socketserver.StreamRequestHandler):
                     lambda self, *args: self.new_registration(*args)),
             GET_LICENSES_STARTING_WITH=(
                     lambda self, *args: self.get_licenses_starting_with(*args)),
+            MGET_CAR_DETAILS=(
+                    lambda self, *args: self.mget_car_details(*args)),
+            MNEW_REGISTRATION=(
+                    lambda self, *args: self.mnew_registration(*args)),
+            STATS=lambda self, *args: self.stats(*args),
             SHUTDOWN=lambda self, *args: self.shutdown(*args))
 
 
-    def handle(self):
-        version = 1
-        SizeStruct = struct.Struct("!IB")
-        info = self.rfile.read(SizeStruct.size)
-        size, client_version = SizeStruct.unpack(info)
-        if version >= client_version:
-            data = pickle.loads(self.rfile.read(size))
-            try:
-                with self.CallLock:
-                    function = self.Call[data[0]]
-                reply = function(self, *data[1:])
-            except Finish:
-                return
+    @staticmethod
+    def set_cars(cars, journal=None):
+        """Makes cars (a dict of Car objects keyed by license) the
+        registrations that every handler serves, logging changes to
+        journal if it is given
+        """
+        RegistrationOperations.Cars = cars
+        RegistrationOperations.Licenses = sorted(cars)
+        RegistrationOperations.Journal = journal
+
+
+    def accepts(self, client_version):
+        """Returns True if requests from a client using client_version
+        of the protocol can be served
+
+        Versions 1 and 2 are pickled, so they are refused unless
+        AllowPickle is True.
+        """
+        return (client_version <= self.Version and
+                (client_version >= 3 or self.AllowPickle))
+
+
+    def decode(self, client_version, data):
+        """Returns the request id (None for a version 1 client) and the
+        request items held in a frame's data
+
+        A version 1 client sends exactly one request per connection; a
+        version 2 client keeps the connection open and may send many
+        requests, each tagged with an id that is echoed in its reply,
+        without waiting for earlier replies. Version 3 is version 2
+        with car_registration_codec in place of pickle. Raises
+        CodecError if a version 3 frame is malformed.
+        """
+        if client_version >= 3:
+            return car_registration_codec.decode_request(data)
+        if client_version == 1:
+            return None, pickle.loads(data)
+        return pickle.loads(data)
+
+
+    def encode(self, client_version, request_id, reply, verb=None):
+        """Returns the complete frame that carries reply to a verb
+        request
+
+        A reply sent before any request has been read, such as a
+        refusal, goes to a version 2 or later client with request id 0.
+        """
+        if request_id is None and client_version >= 2:
+            request_id = 0
+        if client_version >= 3:
+            data = car_registration_codec.encode_reply(request_id, reply,
+                                                       verb)
         else:
-            reply = (False, 'Incompatible client')
-        data = pickle.dumps(reply, 3)
-        self.wfile.write(SizeStruct.pack(len(data), version))
-        self.wfile.write(data)
+            data = pickle.dumps(reply if request_id is None
+                                else (request_id, reply), 3)
+        return self.SizeStruct.pack(len(data), min(client_version,
+                                                   self.Version)) + data
+
+
+    def dispatch(self, items):
+        function = self.Call.get(items[0])
+        if function is None:
+            return (False, "Unknown request {0}".format(items[0]))
+        try:
+            return function(self, *items[1:])
+        except TypeError:
+            # A pickled request is not checked against a schema
+            return (False, "Invalid arguments for {0}".format(items[0]))
+
+
+    def record(self, items, start, bytes_in, reply, frame):
+        """Records a request, served from start (a time.perf_counter()
+        value) until its reply frame was written, in Metrics
+        """
+        verb = items[0] if items and items[0] in self.Call else "UNKNOWN"
+        self.Metrics.record(verb, time.perf_counter() - start, bytes_in,
+                            len(frame), bool(reply and reply[0]))
+
+
+    def car_lock(self, license):
+        return self.ShardLocks[hash(license) % len(self.ShardLocks)]
 
 
     def get_car_details(self, license):
-        with self.CarsLock:
-            car = copy.copy(self.Cars.get(license, None))
-        if car is not None:
-            return (True, car.seats, car.mileage, car.owner)
+        with self.CarsLock.read_locked(), self.car_lock(license):
+            car = self.Cars.get(license, None)
+            if car is not None:
+                return (True, car.seats, car.mileage, car.owner)
         return (False, "This license is not registered")
         
 
     def change_mileage(self, license, mileage):
         if mileage < 0:
             return (False, "Cannot set a negative mileage")
-        with self.CarsLock:
+        with self.CarsLock.read_locked(), self.car_lock(license):
             car = self.Cars.get(license, None)
-            if car is not None:
-                if car.mileage < mileage:
-                    car.mileage = mileage
-                    return (True, None)
+            if car is None:
+                return (False, "This license is not registered")
+            if car.mileage >= mileage:
                 return (False, "Cannot wind the odometer back")
-        return (False, "This license is not registered")
+            car.mileage = mileage
+            ticket = self.log("CHANGE_MILEAGE", license, mileage)
+        return self.commit(ticket)
         
 
     def change_owner(self, license, owner):
         if not owner:
             return (False, "Cannot set an empty owner")
-        with self.CarsLock:
+        with self.CarsLock.read_locked(), self.car_lock(license):
             car = self.Cars.get(license, None)
-            if car is not None:
-                car.owner = owner
-                return (True, None)
-        return (False, "This license is not registered")
+            if car is None:
+                return (False, "This license is not registered")
+            car.owner = owner
+            ticket = self.log("CHANGE_OWNER", license, owner)
+        return self.commit(ticket)
         
 
-    def new_registration(self, license, seats, mileage, owner):
+    def mget_car_details(self, licenses):
+        """Returns (True, replies) where replies holds what
+        get_car_details() would return for each of the licenses
+        """
+        replies = []
+        with self.CarsLock.read_locked():
+            for license in licenses:
+                with self.car_lock(license):
+                    car = self.Cars.get(license, None)
+                    if car is not None:
+                        replies.append((True, car.seats, car.mileage,
+                                        car.owner))
+                        continue
+                replies.append((False, "This license is not registered"))
+        return (True, replies)
+
+
+    def check_registration(self, license, seats, mileage, owner):
         if not license:
             return (False, "Cannot set an empty license")
         if seats not in {2, 4, 5, 6, 7, 8, 9}:
@@ -137,40 +645,288 @@ class RequestHandler(socketserver.StreamRequestHandler):
             return (False, "Cannot set a negative mileage")
         if not owner:
             return (False, "Cannot set an empty owner")
-        with self.CarsLock:
-            if license not in self.Cars:
-                self.Cars[license] = Car(seats, mileage, owner)
-                return (True, None)
-        return (False, "Cannot register duplicate license")
-
-
-    def get_licenses_starting_with(self, symbols):
-        with self.CarsLock:
-            keys = self.Cars.keys()
-        licenses = [key for key in keys if key.startswith(symbols)]
-        licenses.sort()
+        return None
+
+
+    def new_registration(self, license, seats, mileage, owner):
+        reply = self.check_registration(license, seats, mileage, owner)
+        if reply is not None:
+            return reply
+        with self.CarsLock.write_locked():
+            if license in self.Cars:
+                return (False, "Cannot register duplicate license")
+            self.Cars[license] = Car(seats, mileage, owner)
+            bisect.insort(self.Licenses, license)
+            ticket = self.log("NEW_REGISTRATION", license, seats, mileage,
+                              owner)
+        return self.commit(ticket)
+
+
+    def mnew_registration(self, registrations):
+        """Registers each (license, seats, mileage, owner) item of
+        registrations and returns (True, replies) where replies holds
+        what new_registration() would return for each of them
+
+        The registrations are made under one acquisition of the write
+        lock and journalled as a single change.
+        """
+        replies = []
+        with self.CarsLock.write_locked():
+            added = []
+            for registration in registrations:
+                reply = self.check_registration(*registration)
+                if reply is None:
+                    license, seats, mileage, owner = registration
+                    if license in self.Cars:
+                        reply = (False, "Cannot register duplicate license")
+                    else:
+                        self.Cars[license] = Car(seats, mileage, owner)
+                        added.append(tuple(registration))
+                        reply = (True, None)
+                replies.append(reply)
+            if not added:
+                return (True, replies)
+            # Appending a sorted run and sorting is a linear merge
+            self.Licenses.extend(sorted(registration[0]
+                                        for registration in added))
+            self.Licenses.sort()
+            ticket = self.log("MNEW_REGISTRATION", added)
+        ok, *data = self.commit(ticket)
+        return (True, replies) if ok else (ok, *data)
+
+
+    def log(self, *change):
+        # Called with the car locked, so a car's changes are journalled
+        # in the order they are made
+        if self.Journal is not None:
+            return self.Journal.log(*change)
+
+
+    def commit(self, ticket):
+        # Called with the car unlocked; replies only once the change is
+        # durable
+        if ticket is not None:
+            try:
+                self.Journal.wait(ticket)
+            except EnvironmentError as err:
+                return self.journal_failed(err)
+        return (True, None)
+
+
+    def journal_failed(self, err):
+        return (False, "Cannot journal the change: {0}".format(err))
+
+
+    def get_licenses_starting_with(self, symbols, limit=None, offset=0):
+        """Returns the registered licenses that start with symbols in
+        sorted order, skipping the first offset of them and returning at
+        most limit if it is given
+        """
+        with self.CarsLock.read_locked():
+            start = bisect.bisect_left(self.Licenses, symbols)
+            end = bisect.bisect_left(self.Licenses, symbols + "\U0010FFFF",
+                                     start)
+            start = min(start + max(offset, 0), end)
+            if limit is not None:
+                end = min(end, start + max(limit, 0))
+            licenses = self.Licenses[start:end]
         return (True, *licenses)
         
 
+    def stats(self):
+        """Returns (True, stats) where stats is a dict of the metrics
+        that Metrics.stats() returns
+        """
+        return (True, self.Metrics.stats(self.CarsLock))
+
+
     def shutdown(self, *ignore):
         self.server.shutdown()
         raise Finish()
         
 
-class CarRegistrationServer(socketserver.ThreadingMixIn,
-                            socketserver.TCPServer): pass
+class RequestHandler(RegistrationOperations,
+                     socketserver.StreamRequestHandler):
 
+    disable_nagle_algorithm = True
 
-def save(filename, cars):
+    def handle(self):
+        """Serves every request that arrives on the connection"""
+        self.Metrics.connected()
+        while True:
+            info = self.rfile.read(self.SizeStruct.size)
+            if len(info) < self.SizeStruct.size:
+                return
+            start = time.perf_counter()
+            size, client_version = self.SizeStruct.unpack(info)
+            if not self.accepts(client_version):
+                self.wfile.write(self.encode(client_version, None,
+                                 (False, "Incompatible client")))
+                return
+            try:
+                request_id, items = self.decode(client_version,
+                                                self.rfile.read(size))
+            except car_registration_codec.CodecError:
+                return
+            try:
+                reply = self.dispatch(items)
+            except Finish:
+                return
+            frame = self.encode(client_version, request_id, reply,
+                                items[0])
+            self.wfile.write(frame)
+            self.record(items, start, len(info) + size, reply, frame)
+            if client_version == 1:
+                return
+
+
+class CarRegistrationServer(socketserver.ThreadingMixIn,
+                            socketserver.TCPServer):
+
+    allow_reuse_address = True
+    request_queue_size = 4096
+    # Connections stay open between requests, so the handler threads
+    # must not keep the process alive after a SHUTDOWN
+    daemon_threads = True
+
+
+class AsyncRequestHandler(RegistrationOperations):
+
+    def __init__(self, server):
+        """Serves one connection as a coroutine of the asyncio engine
+
+        The operations are the same as RequestHandler's, except that
+        waiting for the journal is done in an executor thread so that
+        the event loop is never blocked by an fsync.
+        """
+        self.server = server
+        self.ticket = None
+
+
+    async def handle(self, reader, writer):
+        self.Metrics.connected()
+        try:
+            while True:
+                try:
+                    info = await reader.readexactly(self.SizeStruct.size)
+                    start = time.perf_counter()
+                    size, client_version = self.SizeStruct.unpack(info)
+                    if not self.accepts(client_version):
+                        writer.write(self.encode(client_version, None,
+                                     (False, "Incompatible client")))
+                        break
+                    data = await reader.readexactly(size)
+                    request_id, items = self.decode(client_version, data)
+                except (asyncio.IncompleteReadError,
+                        car_registration_codec.CodecError):
+                    break
+                try:
+                    reply = self.dispatch(items)
+                except Finish:
+                    break
+                if self.ticket is not None:
+                    reply = await self.committed(reply)
+                frame = self.encode(client_version, request_id, reply,
+                                    items[0])
+                writer.write(frame)
+                await writer.drain()
+                self.record(items, start, len(info) + size, reply, frame)
+                if client_version == 1:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+    def commit(self, ticket):
+        self.ticket = ticket
+        return (True, None)
+
+
+    async def committed(self, reply):
+        ticket, self.ticket = self.ticket, None
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                    None, self.Journal.wait, ticket)
+        except EnvironmentError as err:
+            return self.journal_failed(err)
+        return reply
+
+
+class AsyncCarRegistrationServer:
+
+    def __init__(self, server_address, backlog=4096):
+        """A car registration server that serves every connection from
+        a single thread using asyncio
+
+        It has the same serve_forever() and shutdown() methods as
+        CarRegistrationServer; shutdown() may be called from any thread.
+        Clients keep their connections open between requests, so
+        shutting down closes every connection that is still open.
+        """
+        self.server_address = server_address
+        self.backlog = backlog
+        self.__loop = None
+        self.__stopped = None
+        self.__writers = set()
+
+
+    def serve_forever(self):
+        asyncio.run(self.__serve())
+
+
+    def shutdown(self):
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__stopped.set)
+
+
+    async def __serve(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__stopped = asyncio.Event()
+        try:
+            server = await asyncio.start_server(self.__handle,
+                    *self.server_address, backlog=self.backlog)
+            self.server_address = server.sockets[0].getsockname()
+            async with server:
+                await self.__stopped.wait()
+                server.close()
+                for writer in self.__writers:
+                    writer.close()
+        finally:
+            self.__loop = None
+
+
+    async def __handle(self, reader, writer):
+        self.__writers.add(writer)
+        try:
+            await AsyncRequestHandler(self).handle(reader, writer)
+        finally:
+            self.__writers.discard(writer)
+
+
+def save(filename, cars, segment=0):
+    """Saves cars followed by the number of the first journal segment
+    that is not already reflected in them
+    """
+    temporary = filename + ".tmp"
     try:
-        with contextlib.closing(gzip.open(filename, "wb")) as fh:
+        with contextlib.closing(gzip.open(temporary, "wb")) as fh:
             pickle.dump(cars, fh, 3)
-    except (EnvironmentError, pickle.UnpicklingError) as err:
+            pickle.dump(segment, fh, 3)
+        with open(temporary, "rb") as fh:
+            os.fsync(fh.fileno())
+        os.replace(temporary, filename)
+        return True
+    except (EnvironmentError, pickle.PicklingError) as err:
         print("server failed to save data: {0}".format(err))
-        sys.exit(1)
+        return False
 
 
 def load(filename):
+    """Returns the saved cars and the number of the first journal
+    segment that must be replayed on top of them
+    """
     if not os.path.exists(filename):
         # Generate fake data
         cars = {}
@@ -195,33 +951,71 @@ def load(filename):
             seats = random.choice((2, 4, 5, 6, 7))
             owner = random.choice(owners)
             cars[license] = Car(seats, mileage, owner)
-        return cars
-        #return {}
+        return cars, 0
+        #return {}, 0
     try:
         with contextlib.closing(gzip.open(filename, "rb")) as fh:
-            return pickle.load(fh)
+            cars = pickle.load(fh)
+            try:
+                segment = pickle.load(fh)
+            except EOFError: # Saved before there was a journal
+                segment = 0
+        return cars, segment
     except (EnvironmentError, pickle.UnpicklingError) as err:
         print("server cannot load data: {0}".format(err))
         sys.exit(1)
 
 
 def main():
+    opts = parse_options()
     filename = os.path.join(os.path.dirname(__file__),
                             "car_registrations.dat")
-    cars = load(filename)
+    journal_filename = os.path.splitext(filename)[0] + ".journal"
+    cars, segment = load(filename)
     print("Loaded {0} car registrations".format(len(cars)))
-    RequestHandler.Cars = cars
+    count = replay(journal_filename, segment, cars)
+    if count:
+        print("Replayed {0} journalled changes".format(count))
+    journal = Journal(journal_filename, segment)
+    RegistrationOperations.set_cars(cars, journal)
+    RegistrationOperations.AllowPickle = opts.allow_pickle
+    snapshotter = Snapshotter(filename, journal)
+    snapshotter.start()
     server = None
     try:
-        server = CarRegistrationServer(("", 9653), RequestHandler)
+        if opts.engine == "asyncio":
+            server = AsyncCarRegistrationServer(("", opts.port))
+        else:
+            server = CarRegistrationServer(("", opts.port), RequestHandler)
         server.serve_forever()
     except Exception as err:
         print("ERROR", err)
     finally:
         if server is not None:
             server.shutdown()
-            save(filename, cars)
-            print("Saved {0} car registrations".format(len(cars)))
-
-
-main()
+        snapshotter.stop()
+        print("Saved {0} car registrations".format(
+              snapshot(filename, journal)))
+        journal.close()
+        print(format_stats(RegistrationOperations.Metrics.stats(
+              RegistrationOperations.CarsLock)))
+
+
+def parse_options():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-e", "--engine", dest="engine",
+            choices=("threading", "asyncio"), default="threading",
+            help=("serve with a thread per connection (threading) or "
+                  "with one event loop (asyncio) [default %default]"))
+    parser.add_option("-p", "--port", dest="port", default=9653,
+            type="int", help="the port to listen on [default %default]")
+    parser.add_option("-n", "--no-pickle", dest="allow_pickle",
+            default=True, action="store_false",
+            help=("refuse clients that use the pickled protocol "
+                  "versions 1 and 2"))
+    opts, args = parser.parse_args()
+    return opts
+
+
+if __name__ == "__main__":
+    main()